@@ -41,6 +41,11 @@ setup(
     url='https://github.com/thecubic/zedswarm',
     packages=['zedswarm'],
     install_requires=requirements,
+    entry_points={
+        'console_scripts': [
+            'zedswarm-drone = zedswarm.launcher:main',
+        ],
+    },
     zip_safe=False,    
     license='Apache 2.0',
     classifiers=(
@@ -113,8 +113,7 @@ if __name__ == '__main__':
             _b = time.time()
             for responder, response in master.cats(_catname, certain=True,
                                                    generator=True,
-                                                   providers=providers,
-                                                   timeout=1.0):
+                                                   providers=providers):
                 master.log.info("@%0.5f %s:\"%s\"" % (time.time() - _b,
                                                       getalias(responder), response))
             _a = time.time()
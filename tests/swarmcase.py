@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2013 Dave Carlson <thecubic@thecubic.net>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"in-process swarms on LocalKazoo and inproc sockets, for the tests"
+
+import threading
+import time
+import unittest
+import uuid
+
+import zmq
+
+import zedswarm
+
+
+def vector(name):
+    "a bind_vector of fresh inproc endpoints"
+    _base = "inproc://%s.%s" % (name, uuid.uuid4())
+    return ["%s.in" % _base, "%s.in" % _base,
+            "%s.out" % _base, "%s.out" % _base]
+
+
+class SwarmCase(unittest.TestCase):
+    "a zookeeper and zmq context of its own for every test"
+    # for the subscriptions to make it round
+    settle = 0.2
+
+    def setUp(self):
+        self.zk = zedswarm.LocalKazoo()
+        self.context = zmq.Context()
+        self.context.linger = 0
+        # (primitive, thread running it or None)
+        self.members = []
+
+    def tearDown(self):
+        for _member, _thread in self.members:
+            if _thread is not None:
+                _member.stop()
+                _thread.join(5.0)
+        for _member, _thread in self.members:
+            _member.close()
+        self.context.term()
+
+    def run_member(self, member, target=None):
+        _thread = None
+        if target is not None:
+            _thread = threading.Thread(target=target,
+                                       name="%s.%s" % (member.name,
+                                                       target.__name__))
+            # in case a test leaves one stuck
+            _thread.daemon = True
+            _thread.start()
+        self.members.append((member, _thread))
+        return member
+
+    def master(self, control=False, **kwargs):
+        return self.run_member(zedswarm.zSwarmMaster(
+            name="test-master", kazoo_context=self.zk,
+            zmq_context=self.context, bind_vector=vector('master'),
+            control_vector=vector('master-ctl') if control else None,
+            **kwargs))
+
+    def relay(self, control=False, **kwargs):
+        _relay = zedswarm.zSwarmRelay(
+            name="test-relay", kazoo_context=self.zk,
+            zmq_context=self.context, bind_vector=vector('relay'),
+            control_vector=vector('relay-ctl') if control else None,
+            **kwargs)
+        return self.run_member(_relay, _relay.proxy)
+
+    def drone(self, handlers=None, setup=None, **kwargs):
+        "a drone serving handlers, set up by setup(drone) before it runs"
+        _drone = zedswarm.zSwarmDrone(name="test-drone",
+                                      kazoo_context=self.zk,
+                                      zmq_context=self.context, **kwargs)
+        # sockets belong to the sniffer thread once it starts
+        if handlers:
+            _drone.register_many(handlers)
+        if setup is not None:
+            setup(_drone)
+        return self.run_member(_drone, _drone.blocking_sniffer)
+
+    def wait(self, seconds=None):
+        time.sleep(self.settle if seconds is None else seconds)
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2013 Dave Carlson <thecubic@thecubic.net>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"batch handlers take many queued calls at once, each still gets its answer"
+
+import time
+import unittest
+
+from swarmcase import SwarmCase
+
+MAX_BATCH = 16
+
+
+class Batching(SwarmCase):
+
+    def setUp(self):
+        super(Batching, self).setUp()
+        self.batches = []
+
+        def double(calls):
+            self.batches.append(len(calls))
+            return [_n * 2 for (_n,) in calls]
+
+        def miscount(calls):
+            return [None]
+
+        def setup(drone):
+            drone.register_batch('double', double, max_batch=MAX_BATCH,
+                                 max_wait=0.01)
+            drone.register_batch('miscount', miscount)
+
+        self.m = self.master()
+        self.d = self.drone({'cats': lambda name: "sup, %s" % name},
+                            setup=setup)
+        self.wait()
+
+    def test_every_call_answered(self):
+        _calls = [self.m.double(_n, timeout=2.0) for _n in xrange(200)]
+        for _n, _call in enumerate(_calls):
+            self.assertEqual([_r[1] for _r in _call], [_n * 2])
+        self.assertEqual(sum(self.batches), 200)
+        self.assertTrue(len(self.batches) < 200)
+        self.assertTrue(max(self.batches) <= MAX_BATCH)
+        self.assertEqual(self.d.counters['batched'], 200)
+
+    def test_lone_call(self):
+        _started = time.time()
+        self.assertEqual([_r[1] for _r in self.m.double(21)], [42])
+        self.assertEqual(self.batches, [1])
+        # waits max_wait for company, no longer
+        self.assertTrue(time.time() - _started < 0.2)
+
+    def test_mixed_with_plain_calls(self):
+        _calls = []
+        for _n in xrange(30):
+            _calls.append(('double', _n, self.m.double(_n, timeout=2.0)))
+            _calls.append(('cats', _n, self.m.cats(_n, timeout=2.0)))
+        for _method, _n, _call in _calls:
+            _expected = _n * 2 if _method == 'double' else "sup, %s" % _n
+            self.assertEqual([_r[1] for _r in _call], [_expected])
+
+    def test_miscounted_results_send_nothing(self):
+        _calls = [self.m.miscount(_n, timeout=0.3) for _n in xrange(3)]
+        for _call in _calls:
+            self.assertEqual(list(_call), [])
+        # still serving
+        self.assertEqual([_r[1] for _r in self.m.double(1)], [2])
+
+
+if __name__ == '__main__':
+    unittest.main()
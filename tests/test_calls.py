@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2013 Dave Carlson <thecubic@thecubic.net>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"call handles: several open at once, closing and cancelling"
+
+import time
+import unittest
+
+from swarmcase import SwarmCase
+
+
+class CallHandles(SwarmCase):
+
+    def setUp(self):
+        super(CallHandles, self).setUp()
+        self.ran = []
+        self.m = self.master()
+
+    def cats(self, pause):
+        def cats(name):
+            self.ran.append(name)
+            time.sleep(pause)
+            return "sup, %s" % name
+        return cats
+
+    def test_open_calls_keep_their_replies(self):
+        self.drone({'cats': self.cats(0)})
+        self.drone({'cats': self.cats(0.2)})
+        self.wait()
+        with self.m.cats(1, timeout=1.0) as _a:
+            with self.m.cats(2, timeout=1.0) as _b:
+                # the fast drone's answer to b comes in while we read a
+                _ra = list(_a)
+                _rb = list(_b)
+        self.assertEqual(sorted(_r[1] for _r in _ra), ['sup, 1'] * 2)
+        self.assertEqual(sorted(_r[1] for _r in _rb), ['sup, 2'] * 2)
+        self.assertEqual(self.m.counters['stray'], 0)
+        self.assertEqual(self.m._open_calls, {})
+
+    def test_replies_for_nobody_are_stray(self):
+        self.drone({'cats': self.cats(0)})
+        self.wait()
+        _call = self.m.cats('x', timeout=1.0)
+        _closed = self.m.cats('y', timeout=1.0)
+        _closed.close()
+        # the drone answers before it hears of the unsubscribe, or not
+        self.assertEqual(len(list(_call)), 1)
+        self.assertTrue(self.m.counters['stray'] <= 1)
+        self.assertEqual(self.m._open_calls, {})
+
+    def test_abandoned_call_closes(self):
+        self.drone({'cats': self.cats(0)})
+        self.drone({'cats': self.cats(0)})
+        self.wait()
+        _call = self.m.cats('x', timeout=1.0)
+        for _reply in _call:
+            break
+        # walked away before the deadline: cancelled, not just closed
+        self.assertTrue(_call.closed)
+        self.assertTrue(_call.cancelled)
+        self.assertFalse(_call.id in self.m._open_calls)
+
+    def test_cancel_drops_queued_call(self):
+        self.drone({'cats': self.cats(0.3)})
+        self.wait()
+        _first = self.m.cats('first', timeout=1.0)
+        _second = self.m.cats('second', timeout=1.0)
+        _second.cancel()
+        self.assertEqual(len(list(_first)), 1)
+        self.wait(0.1)
+        self.assertEqual(self.ran, ['first'])
+        self.assertEqual(list(_second), [])
+
+    def test_cancel_reaches_running_handler(self):
+        _drones = []
+
+        def spin():
+            # a long handler checking in every so often
+            _until = time.time() + 2.0
+            while time.time() < _until:
+                if _drones[0].is_cancelled():
+                    self.ran.append('cancelled')
+                    return None
+                time.sleep(0.01)
+            return 'finished'
+
+        _drones.append(self.drone({'spin': spin}))
+        self.wait()
+        _started = time.time()
+        _call = self.m.spin(timeout=3.0)
+        self.wait(0.1)
+        _call.cancel()
+        self.wait(0.1)
+        self.assertEqual(self.ran, ['cancelled'])
+        self.assertTrue(time.time() - _started < 1.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
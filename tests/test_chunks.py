@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2013 Dave Carlson <thecubic@thecubic.net>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"large replies in chunks, reassembled, no further ahead than credit allows"
+
+import mmap
+import unittest
+import warnings
+
+import msgpack
+
+from swarmcase import SwarmCase
+
+CHUNK = 64 << 10
+
+
+def big(n):
+    # not all the same byte, so misplaced chunks show
+    return ''.join(chr(_i % 251) for _i in xrange(256)) * (n // 256)
+
+
+class Chunking(SwarmCase):
+
+    def swarm(self, control=False, drones=1):
+        self.m = self.master(control=control)
+
+        def setup(drone):
+            drone.chunk_size = CHUNK
+            drone.credit_timeout = 0.3
+        self.drones = [self.drone({'big': big}, setup=setup)
+                       for _n in xrange(drones)]
+        self.wait()
+
+    def call(self, n, **kwargs):
+        return list(self.m.request_response_certain('big', [n], timeout=2.0,
+                                                    **kwargs))
+
+    def test_reassembly(self):
+        self.swarm(drones=2)
+        for _n in (CHUNK // 2, CHUNK * 4, CHUNK * 16 + 256):
+            _replies = self.call(_n)
+            self.assertEqual(len(_replies), 2)
+            for _provider, _reply in _replies:
+                self.assertEqual(_reply, big(_n))
+
+    def test_window(self):
+        self.swarm()
+        for _window in (1, 2, 3, 8):
+            _replies = self.call(CHUNK * 8, window=_window)
+            self.assertEqual([_r[1] for _r in _replies], [big(CHUNK * 8)])
+
+    def test_control_lane_credit(self):
+        self.swarm(control=True)
+        _replies = self.call(CHUNK * 16, window=2)
+        self.assertEqual([_r[1] for _r in _replies], [big(CHUNK * 16)])
+        self.assertEqual(self.drones[0].counters['stalled'], 0)
+
+    def test_unchunked(self):
+        self.swarm()
+        _replies = self.call(CHUNK * 4, window=0)
+        self.assertEqual([_r[1] for _r in _replies], [big(CHUNK * 4)])
+
+    def test_raw(self):
+        self.swarm()
+        _replies = self.call(CHUNK * 4, raw=True)
+        self.assertTrue(isinstance(_replies[0][1], bytearray))
+        self.assertEqual(msgpack.unpackb(bytes(_replies[0][1])),
+                         big(CHUNK * 4))
+
+    def test_spooled(self):
+        self.swarm()
+        self.m.spool_threshold = CHUNK * 2
+        _raw = self.call(CHUNK * 4, raw=True)
+        self.assertTrue(isinstance(_raw[0][1], mmap.mmap))
+        with warnings.catch_warnings(record=True) as _caught:
+            warnings.simplefilter('always')
+            _replies = self.call(CHUNK * 4)
+        self.assertEqual([_r[1] for _r in _replies], [big(CHUNK * 4)])
+        self.assertEqual(_caught, [])
+
+    def test_no_credit_stalls(self):
+        self.swarm()
+        # asks for chunks but never grants any credit
+        _id, _subscribe, _send = self.m.publish_replyable(
+            msgpack.packb([CHUNK * 8]), topic='big', meta={'w': 2})
+        self.wait(0.6)
+        _chunks = 0
+        while self.m._in_socket.poll(0):
+            _frames, _meta = self.m.recv_frames()
+            self.assertEqual(_frames[0], _id)
+            _chunks += 1
+        # as far as the window, then gave up
+        self.assertEqual(_chunks, 2)
+        self.assertEqual(self.drones[0].counters['stalled'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
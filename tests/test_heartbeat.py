@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2013 Dave Carlson <thecubic@thecubic.net>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"drones that stop heartbeating drop out of provider lookups"
+
+import time
+import unittest
+
+from swarmcase import SwarmCase
+
+TIMEOUT = 0.3
+INTERVAL = 0.05
+
+
+def cats(name):
+    return "sup, %s" % name
+
+
+def beating(drone):
+    drone.heartbeat_interval = INTERVAL
+
+
+def skewed(drone):
+    "heartbeat with a clock an hour slow"
+    def heartbeat():
+        _now = time.time()
+        if _now - drone._last_heartbeat < drone.heartbeat_interval:
+            return
+        drone._last_heartbeat = _now
+        drone.publish_withid(None, topic=drone.uniqueaddr(),
+                             addr=drone.uniqueaddr(),
+                             meta={'hb': _now - 3600})
+    beating(drone)
+    drone.heartbeat = heartbeat
+
+
+class Heartbeats(SwarmCase):
+
+    def swarm(self, drones=3, setup=beating, **kwargs):
+        self.m = self.master(heartbeat_timeout=TIMEOUT, **kwargs)
+        self.drones = [self.drone({'cats': cats}, setup=setup)
+                       for _n in xrange(drones)]
+        self.wait()
+
+    def test_alive(self):
+        self.swarm()
+        self.m.get_providers('cats')
+        self.wait(TIMEOUT * 2)
+        self.assertEqual(len(self.m.get_providers('cats')), 3)
+        self.assertEqual(self.m.counters['stale'], 0)
+
+    def test_silent_drone_drops_out(self):
+        self.swarm()
+        self.m.get_providers('cats')
+        self.drones[0].heartbeat_interval = None
+        self.wait(TIMEOUT * 2)
+        _providers = self.m.get_providers('cats')
+        self.assertEqual(sorted(_providers),
+                         sorted(_d.uniqueaddr() for _d in self.drones[1:]))
+        self.assertEqual(self.m.counters['stale'], 1)
+        # still up, it just isn't asked
+        self.assertEqual(len(list(self.m.cats('x', only=True))), 2)
+
+    def test_nobody_alive(self):
+        self.swarm()
+        self.m.get_providers('cats')
+        for _drone in self.drones:
+            _drone.heartbeat_interval = None
+        self.wait(TIMEOUT * 2)
+        self.assertRaises(NameError, self.m.get_providers, 'cats')
+        self.assertRaises(NameError, self.m.cats, 'x')
+
+    def test_idle_master_first_lookup(self):
+        # the master sits idle for longer than the timeout before the
+        # drones turn up, then looks them up for the first time
+        self.m = self.master(heartbeat_timeout=TIMEOUT)
+        self.wait(TIMEOUT * 2)
+        self.drones = [self.drone({'cats': cats}, setup=beating)
+                       for _n in xrange(3)]
+        self.wait(TIMEOUT * 2)
+        self.assertEqual(len(self.m.get_providers('cats')), 3)
+        self.assertEqual(len(list(self.m.cats('x'))), 3)
+
+    def test_skewed_clock(self):
+        self.swarm(setup=skewed)
+        self.m.get_providers('cats')
+        self.wait(TIMEOUT * 2)
+        self.assertEqual(len(self.m.get_providers('cats')), 3)
+
+    def test_control_lane(self):
+        self.swarm(control=True)
+        self.m.get_providers('cats')
+        self.wait(TIMEOUT * 2)
+        self.assertEqual(len(self.m.get_providers('cats')), 3)
+
+    def test_through_relay(self):
+        self.m = self.master(heartbeat_timeout=TIMEOUT)
+        self.relay(control=True)
+        self.drones = [self.drone({'cats': cats}, setup=beating,
+                                  use_relays=True)
+                       for _n in xrange(3)]
+        self.wait()
+        self.m.get_providers('cats')
+        self.wait(TIMEOUT * 2)
+        self.assertEqual(len(self.m.get_providers('cats')), 3)
+
+    def test_gone_drones_forgotten(self):
+        self.swarm()
+        self.m.forget_timeouts = 2
+        _gone = self.drones[0]
+        self.m.get_providers('cats')
+        self.wait(TIMEOUT)
+        self.m.get_providers('cats')
+        self.assertTrue(_gone.uniqueaddr() in self.m._last_seen)
+        self.zk.delete('/api/cats/%s' % _gone.uniqueaddr())
+        _gone.heartbeat_interval = None
+        self.wait(TIMEOUT * 3)
+        self.m.get_providers('cats')
+        self.assertFalse(_gone.uniqueaddr() in self.m._last_seen)
+        self.assertFalse(_gone.uniqueaddr() in self.m._first_listed)
+        self.assertEqual(len(self.m._last_seen), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
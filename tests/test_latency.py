@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2013 Dave Carlson <thecubic@thecubic.net>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"reply latency estimates and the deadlines picked from them"
+
+import unittest
+
+from zedswarm.zlatency import LatencyTracker
+
+from swarmcase import SwarmCase
+
+
+def steady(tracker, provider, seconds, n=10, method='cats'):
+    for _n in xrange(n):
+        tracker.observe(method, provider, seconds)
+
+
+class Tracker(unittest.TestCase):
+
+    def setUp(self):
+        self.t = LatencyTracker()
+
+    def test_needs_samples(self):
+        self.assertEqual(self.t.timeout('cats'), None)
+        steady(self.t, 'a', 0.05, n=self.t.min_samples - 1)
+        self.assertEqual(self.t.estimate('cats', 'a'), None)
+        self.assertEqual(self.t.timeout('cats'), None)
+        self.t.observe('cats', 'a', 0.05)
+        self.assertAlmostEqual(self.t.estimate('cats', 'a')[0], 0.05)
+        self.assertTrue(self.t.timeout('cats') >= 0.05)
+
+    def test_unknown_provider_gets_the_default(self):
+        steady(self.t, 'a', 0.05)
+        self.assertEqual(self.t.timeout('cats', ['a', 'b']), None)
+        self.assertTrue(self.t.timeout('cats', ['a']) is not None)
+
+    def test_bounds(self):
+        steady(self.t, 'a', 0.0001)
+        self.assertEqual(self.t.timeout('cats'), self.t.floor)
+        steady(self.t, 'b', 100.0)
+        self.assertEqual(self.t.timeout('cats'), self.t.ceiling)
+
+    def test_covers_the_quantile(self):
+        for _n in xrange(100):
+            self.t.observe('cats', 'a', 0.5 if _n % 50 == 0 else 0.01)
+        self.assertTrue(self.t.timeout('cats') >= 0.5)
+
+    def test_slowest_sets_the_deadline(self):
+        steady(self.t, 'a', 0.01)
+        steady(self.t, 'b', 0.2)
+        self.assertTrue(self.t.timeout('cats') >= 0.2)
+        self.assertTrue(self.t.timeout('cats', ['a']) < 0.2)
+
+    def test_misses_back_off(self):
+        steady(self.t, 'a', 0.05)
+        _before = self.t.timeout('cats')
+        self.assertEqual(self.t.missed('cats', 'a'), 1)
+        self.assertAlmostEqual(self.t.timeout('cats'), _before * 2)
+        # an answer resets it
+        self.t.observe('cats', 'a', 0.05)
+        self.assertTrue(self.t.timeout('cats') < _before * 2)
+
+    def test_unresponsive_left_out_of_the_deadline(self):
+        steady(self.t, 'a', 0.01)
+        steady(self.t, 'b', 0.01)
+        for _n in xrange(self.t.miss_limit):
+            self.t.missed('cats', 'b')
+        self.assertEqual(self.t.unresponsive('cats'), set(['b']))
+        self.assertEqual(self.t.timeout('cats'),
+                         self.t.timeout('cats', ['a']))
+
+    def test_outliers(self):
+        for _provider in 'abc':
+            steady(self.t, _provider, 0.01)
+        self.assertEqual(self.t.outliers('cats'), set())
+        steady(self.t, 'd', 0.01 * self.t.outlier_factor * 4)
+        self.assertEqual(self.t.outliers('cats'), set(['d']))
+        # slow is waited on, not dropped
+        self.assertTrue(self.t.timeout('cats') >= 0.16)
+
+    def test_outliers_need_peers(self):
+        steady(self.t, 'a', 0.01)
+        steady(self.t, 'b', 1.0)
+        self.assertEqual(self.t.outliers('cats'), set())
+
+    def test_forget_and_retain(self):
+        steady(self.t, 'a', 0.01)
+        steady(self.t, 'b', 0.01)
+        steady(self.t, 'a', 0.01, method='dogs')
+        self.t.retain('cats', ['a'])
+        self.assertEqual(self.t.estimate('cats', 'b'), None)
+        self.assertTrue(self.t.estimate('cats', 'a') is not None)
+        self.t.forget('a')
+        self.assertEqual(self.t.estimate('cats', 'a'), None)
+        self.assertEqual(self.t.estimate('dogs', 'a'), None)
+
+
+class MasterDeadlines(SwarmCase):
+
+    def setUp(self):
+        super(MasterDeadlines, self).setUp()
+        self.m = self.master()
+        self.drones = [self.drone({'cats': lambda name: name})
+                       for _n in xrange(3)]
+        self.wait()
+
+    def test_learns_deadline(self):
+        self.assertEqual(self.m.call_timeout('cats'), self.m.timeout)
+        for _n in xrange(LatencyTracker.min_samples):
+            self.assertEqual(len(list(self.m.cats(_n))), 3)
+        _providers = self.m.get_providers('cats')
+        self.assertTrue(self.m.call_timeout('cats', _providers) <
+                        self.m.timeout)
+
+    def test_without_slow(self):
+        _providers = sorted(self.m.get_providers('cats'))
+        for _provider in _providers[:2]:
+            steady(self.m.latency, _provider, 0.001)
+        steady(self.m.latency, _providers[2], 1.0)
+        self.assertEqual(sorted(self.m.without_slow('cats', _providers)),
+                         _providers[:2])
+        self.assertEqual(len(list(self.m.cats('x', exclude_slow=True,
+                                                only=True))), 2)
+
+    def test_gone_providers_forgotten(self):
+        for _n in xrange(LatencyTracker.min_samples):
+            list(self.m.cats(_n))
+        _gone = self.drones[0].uniqueaddr()
+        self.assertTrue(self.m.latency.estimate('cats', _gone) is not None)
+        self.zk.delete('/api/cats/%s' % _gone)
+        self.m.get_providers('cats')
+        self.assertEqual(self.m.latency.estimate('cats', _gone), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
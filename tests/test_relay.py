@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2013 Dave Carlson <thecubic@thecubic.net>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"calls through a relay get every reply a direct call would"
+
+import unittest
+
+from swarmcase import SwarmCase
+
+CALLS = 50
+DRONES = 3
+
+
+def cats(name):
+    return "sup, %s" % name
+
+
+class RelayedCalls(SwarmCase):
+
+    def swarm(self, master_control=False, relay_control=False):
+        self.m = self.master(control=master_control)
+        self.r = self.relay(control=relay_control)
+        self.drones = [self.drone({'cats': cats}, use_relays=True)
+                       for _n in xrange(DRONES)]
+        self.wait()
+
+    def assertEveryReply(self, priority=False):
+        _replies = 0
+        for _n in xrange(CALLS):
+            _replies += len(list(self.m.request_response_certain(
+                'cats', [_n], timeout=0.5, priority=priority)))
+        self.assertEqual(_replies, CALLS * DRONES)
+
+    def test_through_relay(self):
+        self.swarm()
+        for _drone in self.drones:
+            self.assertEqual(list(_drone.master_book),
+                             ['/relays/%s' % self.r.uniqueaddr()])
+        self.assertEveryReply()
+        self.assertTrue(self.r.counters['relayed_up'] >= CALLS * DRONES)
+
+    def test_merged_lanes(self):
+        # control lane above the relay, one lane below it
+        self.swarm(master_control=True)
+        self.assertEveryReply(priority=True)
+        self.assertEveryReply()
+
+    def test_control_relay_bulk_master(self):
+        self.swarm(relay_control=True)
+        self.assertEveryReply(priority=True)
+        self.assertEveryReply()
+
+    def test_control_both(self):
+        self.swarm(master_control=True, relay_control=True)
+        self.assertEveryReply(priority=True)
+        self.assertEveryReply()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2013 Dave Carlson <thecubic@thecubic.net>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"provider discovery by rollcall"
+
+import unittest
+
+from swarmcase import SwarmCase
+
+
+def cats(name):
+    return "sup, %s" % name
+
+
+class Rollcall(SwarmCase):
+
+    def setUp(self):
+        super(Rollcall, self).setUp()
+        self.m = self.master()
+        self.drones = [self.drone({'cats': cats}) for _n in xrange(5)]
+        self.drone({'dogs': cats})
+        self.wait()
+
+    def test_everybody_answers(self):
+        _providers = self.m.get_providers_rc('cats', cached=False,
+                                             crosscheck=True)
+        self.assertEqual(sorted(_providers),
+                         sorted(_d.uniqueaddr() for _d in self.drones))
+
+    def test_maxp(self):
+        # replies come in a burst, more than asked for are waiting
+        for _maxp in (1, 2, 4):
+            self.assertEqual(len(self.m.get_providers_rc(
+                'cats', maxp=_maxp, cached=False)), _maxp)
+
+    def test_cached(self):
+        _providers = self.m.get_providers_rc('cats', maxp=2)
+        self.assertEqual(self.m.get_providers_rc('cats'), _providers)
+
+    def test_nobody(self):
+        self.assertRaises(NameError, self.m.get_providers_rc, 'birds',
+                          timeout=0.05)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2013 Dave Carlson <thecubic@thecubic.net>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"drones drop calls that are past their deadline, and only those"
+
+import time
+import unittest
+
+from swarmcase import SwarmCase
+
+
+class Shedding(SwarmCase):
+
+    def setUp(self):
+        super(Shedding, self).setUp()
+        self.calls = []
+
+        def cats(name, pause=0):
+            self.calls.append(name)
+            time.sleep(pause)
+            return "sup, %s" % name
+
+        self.m = self.master()
+        self.d = self.drone({'cats': cats})
+        self.wait()
+
+    def test_expired_calls_are_shed(self):
+        # ties the drone up while the next ones run out of time
+        _slow = self.m.request_response_certain('cats', ['slow', 0.3],
+                                                timeout=1.0)
+        _late = [self.m.request_response_certain('cats', [_n], timeout=0.1)
+                 for _n in xrange(3)]
+        self.assertEqual(len(list(_slow)), 1)
+        self.wait(0.1)
+        for _call in _late:
+            self.assertEqual(list(_call), [])
+        self.assertEqual(self.calls, ['slow'])
+        self.assertEqual(self.d.counters['shed'], 3)
+
+    def test_slow_call_does_not_shed_later_ones(self):
+        # one slow call used to shed every later call with a shorter
+        # deadline than it took
+        _first = list(self.m.request_response_certain('cats', ['cold', 0.4],
+                                                      timeout=1.0))
+        self.assertEqual(len(_first), 1)
+        for _n in xrange(5):
+            self.assertEqual(len(list(self.m.request_response_certain(
+                'cats', [_n]))), 1)
+        self.assertEqual(len(self.calls), 6)
+        self.assertEqual(self.d.counters['shed'], 0)
+
+    def test_report_shed(self):
+        self.d.report_shed = True
+        _slow = self.m.request_response_certain('cats', ['slow', 0.3],
+                                                timeout=1.0)
+        _late = self.m.request_response_certain('cats', ['late'],
+                                                timeout=0.1)
+        list(_slow)
+        self.wait(0.1)
+        self.assertEqual(self.d.counters['shed'], 1)
+        # the report comes back marked shed, not as an answer
+        self.assertTrue(self.m._in_socket.poll(1000))
+        _frames, _meta = self.m.recv_frames(self.m.in_sock_type)
+        self.assertEqual(_frames[:2], [_late.id, self.d.uniqueaddr()])
+        self.assertTrue(_meta['shed'])
+        _late.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2013 Dave Carlson <thecubic@thecubic.net>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"round trips the wire envelope, no zookeeper or sockets needed"
+
+import itertools
+import struct
+import unittest
+import uuid
+
+from zedswarm import zwire
+
+ADDRS = [
+    # a call's reply id
+    zwire.new_id(),
+    # packs down to a kind and a uuid
+    "drone=%s" % uuid.uuid4(),
+    "master=%s" % uuid.uuid4(),
+    # spelled out after the header
+    "drone=not-a-uuid",
+    "relay=%s" % uuid.uuid4(),
+    "",
+]
+
+SENDERS = [None, "master=%s" % uuid.uuid4(), "master=somewhere"]
+# mutually exclusive on the wire, they share a header field
+TIMES = [{}, {'d': 1381000000.25}, {'hb': 1381000001.5}]
+WINDOWS = [{}, {'w': 8}, {'credit': 65535}]
+CHUNKS = [{}, {'c': 3, 'k': 7, 'z': (5 << 30) + 11, 'o': 3 << 30}]
+PAYLOADS = [None, '', '\x93\x01\x02\x03', '\x00' * 1024]
+
+
+def metas():
+    "every combination of the metadata the envelope can carry"
+    for _sender, _time, _window, _chunk, _shed, _ctl in itertools.product(
+            SENDERS, TIMES, WINDOWS, CHUNKS, (False, True), (False, True)):
+        _meta = dict()
+        if _sender is not None:
+            _meta.update(s=_sender, n=0xfffffffe)
+        _meta.update(_time)
+        _meta.update(_window)
+        _meta.update(_chunk)
+        if _shed:
+            _meta['shed'] = True
+        if _ctl:
+            _meta['ctl'] = True
+        yield _meta
+
+
+class EnvelopeRoundTrip(unittest.TestCase):
+
+    def assertRoundTrip(self, topic, addr, payload, meta):
+        _parts = zwire.encode_envelope(topic, addr, payload, meta)
+        self.assertEqual(len(_parts), 2 if payload is None else 3)
+        _frames, _meta = zwire.decode_envelope(_parts)
+        _expected = [topic, addr]
+        if payload is not None:
+            _expected.append(payload)
+        self.assertEqual(_frames, _expected)
+        self.assertEqual(_meta, meta or None)
+
+    def test_every_flag_combination(self):
+        for _meta in metas():
+            for _addr in ADDRS:
+                self.assertRoundTrip('cats', _addr, '\x91\xa1x', _meta)
+
+    def test_payloads(self):
+        for _payload in PAYLOADS:
+            for _meta in (None, {'d': 1.0}, {'c': 0, 'k': 1, 'z': 0, 'o': 0}):
+                self.assertRoundTrip('cats', ADDRS[1], _payload, _meta)
+
+    def test_topics(self):
+        # replies go to a reply id, heartbeats to a uniqueaddr
+        for _topic in ('', '_rollcall', ADDRS[0], ADDRS[1], ADDRS[3]):
+            self.assertRoundTrip(_topic, ADDRS[2], None, {'hb': 2.0})
+
+    def test_named_addrs_share_the_header(self):
+        # addr, then sender, both spelled out after the chunk fields
+        _meta = {'s': 'drone=two', 'n': 1, 'c': 0, 'k': 2, 'z': 3, 'o': 0}
+        self.assertRoundTrip('cats', 'drone=one', 'x', _meta)
+        _parts = zwire.encode_envelope('cats', 'drone=one', 'x', _meta)
+        self.assertEqual(len(_parts[1]),
+                         zwire.HEADER.size + zwire.CHUNK.size +
+                         2 * zwire.NAMELEN.size + len('drone=one') +
+                         len('drone=two'))
+
+    def test_uuid_addrs_pack_small(self):
+        _parts = zwire.encode_envelope('cats', ADDRS[1], None,
+                                       {'s': ADDRS[2], 'n': 1})
+        self.assertEqual(len(_parts[1]), zwire.HEADER.size)
+
+    def test_uncanonical_uuid_stays_named(self):
+        # has to come back out exactly as it went in
+        _addr = "drone=%s" % str(uuid.uuid4()).upper()
+        self.assertRoundTrip('cats', _addr, None, None)
+        _parts = zwire.encode_envelope('cats', _addr)
+        self.assertTrue(len(_parts[1]) > zwire.HEADER.size)
+
+    def test_exclusive_fields(self):
+        # deadline wins over heartbeat, window over credit
+        _frames, _meta = zwire.decode_envelope(zwire.encode_envelope(
+            'cats', ADDRS[0], 'x', {'d': 1.0, 'hb': 2.0, 'w': 4,
+                                    'credit': 9}))
+        self.assertEqual(_meta, {'d': 1.0, 'w': 4})
+
+
+class EnvelopeRejects(unittest.TestCase):
+
+    def setUp(self):
+        self.parts = zwire.encode_envelope('cats', ADDRS[1], 'x',
+                                           {'s': ADDRS[2], 'n': 1})
+
+    def test_version(self):
+        _header = chr(zwire.ENVELOPE_VERSION + 1) + self.parts[1][1:]
+        self.assertRaises(ValueError, zwire.decode_envelope,
+                          [self.parts[0], _header, self.parts[2]])
+
+    def test_short_header(self):
+        self.assertRaises(ValueError, zwire.decode_envelope,
+                          [self.parts[0], self.parts[1][:-1],
+                           self.parts[2]])
+
+    def test_truncated_chunk_fields(self):
+        _parts = zwire.encode_envelope('cats', ADDRS[0], 'x',
+                                       {'c': 0, 'k': 1, 'z': 1, 'o': 0})
+        self.assertRaises(struct.error, zwire.decode_envelope,
+                          [_parts[0], _parts[1][:zwire.HEADER.size + 4],
+                           _parts[2]])
+
+    def test_missing_terminator(self):
+        self.assertRaises(ValueError, zwire.decode_envelope,
+                          ['cats', self.parts[1], self.parts[2]])
+
+    def test_frame_count(self):
+        self.assertRaises(ValueError, zwire.decode_envelope,
+                          self.parts[:1])
+        self.assertRaises(ValueError, zwire.decode_envelope,
+                          self.parts + ['extra'])
+
+    def test_unknown_kind(self):
+        # a kind we have no swarmtype for
+        _header = self.parts[1][:2] + '\x07' + self.parts[1][3:]
+        self.assertRaises(KeyError, zwire.decode_envelope,
+                          [self.parts[0], _header, self.parts[2]])
+
+
+if __name__ == '__main__':
+    unittest.main()
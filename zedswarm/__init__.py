@@ -15,11 +15,16 @@
 #    limitations under the License.
 
 import logging
-loglevel = logging.INFO
-logging.basicConfig(level=loglevel)
+# configuring logging is the application's business, not ours
 log = logging.getLogger('zedswarm')
+log.addHandler(logging.NullHandler())
 
 from .zprimitive import *
 from .zmaster import *
 from .zdrone import *
 from .zkazoo import *
+from .zhost import *
+from .zlatency import *
+from .zwire import *
+from .zrecord import *
+from .zrelay import *
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2013 Dave Carlson <thecubic@thecubic.net>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""zedswarm-drone: prefork a host's worth of drones
+
+handler modules are imported once, before forking, and each either
+defines HANDLERS = {method: func} or register(drone). every worker
+gets its own zookeeper session and zmq context, since neither
+survives a fork.
+"""
+
+import os
+import sys
+import time
+import signal
+import logging
+import argparse
+import importlib
+import multiprocessing
+
+from .zkazoo import KazooContext
+from .zdrone import zSwarmDrone
+
+log = logging.getLogger('zedswarm.launcher')
+
+
+def parse_args(argv=None):
+    _parser = argparse.ArgumentParser(
+        prog='zedswarm-drone',
+        description='run drones serving the handlers in MODULEs')
+    _parser.add_argument('modules', metavar='MODULE', nargs='+',
+                         help='module defining HANDLERS or register(drone)')
+    _parser.add_argument('-n', '--workers', type=int,
+                         default=multiprocessing.cpu_count(),
+                         help='drone processes to run (default: %(default)s)')
+    _parser.add_argument('-z', '--zookeeper', default='127.0.0.1:2181',
+                         help='zookeeper hosts (default: %(default)s)')
+    _parser.add_argument('--name', default='drone',
+                         help='worker name prefix (default: %(default)s)')
+    _parser.add_argument('--use-relays', action='store_true',
+                         help='go through a relay instead of every master')
+    _parser.add_argument('--locality',
+                         help='prefer relays with this locality')
+    _parser.add_argument('--restart-delay', type=float, default=1.0,
+                         help='seconds before restarting a dead worker, '
+                              'doubled while they keep dying young '
+                              '(default: %(default)s)')
+    _parser.add_argument('--log-level', default='INFO',
+                         help='(default: %(default)s)')
+    return _parser.parse_args(argv)
+
+
+def load_handlers(modules):
+    "import handler modules, returning them"
+    # handler modules usually live wherever we were started from
+    if '' not in sys.path:
+        sys.path.insert(0, '')
+    _loaded = []
+    for _name in modules:
+        _module = importlib.import_module(_name)
+        if not hasattr(_module, 'HANDLERS') and \
+                not hasattr(_module, 'register'):
+            raise ValueError("%s has neither HANDLERS nor register()" %
+                             _name)
+        _loaded.append(_module)
+    return _loaded
+
+
+def prime_zookeeper(hosts):
+    "check zookeeper is there and lay out the paths drones expect"
+    _zk = KazooContext(hosts=hosts)
+    _zk.start()
+    try:
+        for _path in ('/api', '/masters'):
+            _zk.ensure_path(_path)
+    finally:
+        # sessions can't be shared across a fork, workers make their own
+        _zk.stop()
+        _zk.close()
+        KazooContext._instance = None
+
+
+def run_worker(n, args, modules):
+    "body of one forked worker, never returns"
+    import zmq
+    _zk = KazooContext(hosts=args.zookeeper)
+    _drone = zSwarmDrone(name="%s-%d" % (args.name, n),
+                         zmq_context=zmq.Context(), kazoo_context=_zk,
+                         use_relays=args.use_relays, locality=args.locality)
+    for _module in modules:
+        if hasattr(_module, 'register'):
+            _module.register(_drone)
+        else:
+            _drone.register_many(_module.HANDLERS)
+    _drone.log.info("serving %s", ', '.join(sorted(_drone._methods)))
+    _drone.blocking_sniffer()
+
+
+class Supervisor(object):
+    "forks workers and keeps that many running"
+    # a worker that dies quicker than this doesn't reset its backoff
+    min_uptime = 10.0
+    max_delay = 60.0
+    stopping = False
+
+    def __init__(self, args, modules):
+        self.args = args
+        self.modules = modules
+        # pid -> (worker number, started)
+        self.workers = dict()
+        # worker number -> seconds to wait before the next restart
+        self.delays = dict()
+
+    def spawn(self, n):
+        _pid = os.fork()
+        if _pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            _code = 0
+            try:
+                run_worker(n, self.args, self.modules)
+            except Exception:
+                log.exception("worker %d failed", n)
+                _code = 1
+            finally:
+                # skip the parent's atexit and buffered output
+                os._exit(_code)
+        self.workers[_pid] = (n, time.time())
+        log.info("worker %d started as %d", n, _pid)
+        return _pid
+
+    def stop(self, signum=None, frame=None):
+        self.stopping = True
+        for _pid in self.workers:
+            try:
+                os.kill(_pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for _n in xrange(self.args.workers):
+            self.spawn(_n)
+        while self.workers:
+            try:
+                _pid, _status = os.wait()
+            except OSError:
+                # interrupted by a signal, go around again
+                continue
+            if _pid not in self.workers:
+                continue
+            _n, _started = self.workers.pop(_pid)
+            if self.stopping:
+                continue
+            _delay = self.delays.get(_n, self.args.restart_delay)
+            if time.time() - _started >= self.min_uptime:
+                _delay = self.args.restart_delay
+            if os.WIFSIGNALED(_status):
+                _how = "was killed by signal %d" % os.WTERMSIG(_status)
+            else:
+                _how = "exited with status %d" % os.WEXITSTATUS(_status)
+            log.warn("worker %d (%d) %s, restarting in %0.1fs",
+                     _n, _pid, _how, _delay)
+            self.delays[_n] = min(self.max_delay, _delay * 2)
+            time.sleep(_delay)
+            if not self.stopping:
+                self.spawn(_n)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=getattr(logging, args.log_level.upper()))
+    _modules = load_handlers(args.modules)
+    prime_zookeeper(args.zookeeper)
+    log.info("starting %d workers for %s", args.workers,
+             ', '.join(args.modules))
+    Supervisor(args, _modules).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -14,39 +14,69 @@
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
 
+import os
+import zmq
 import msgpack
 import logging
+import threading
+import time
+import collections
 from .zprimitive import zSwarmPrimitive
-from .zkazoo import KazooState, EventType
+from .zkazoo import KazooState, EventType, NoNodeError, RolledBackError
 
 
-class zSwarmDrone(zSwarmPrimitive):
-    swarmtype = "drone"
+def _txfailure(results):
+    "the exception that sank a kazoo transaction, if any"
+    for _res in results:
+        if isinstance(_res, Exception) and \
+                not isinstance(_res, RolledBackError):
+            return _res
+    return None
+
+
+class zSwarmFollower(zSwarmPrimitive):
+    "connects to the masters in zookeeper, keeping up as they come and go"
     # remember: {} is a static attribute
     # which is not what you want
     master_book = None
-    _methods = None
+    # seconds of /masters churn folded into a single refresh
+    refresh_debounce = 0.100
+    # seconds from the first /masters event to the refresh that settled it
+    last_convergence = None
+    _refresh_lock = None
+    _refresh_timer = None
+    _refresh_since = None
+    _refresh_events = 0
+    # (since, events, plan) waiting for the socket thread to carry out
+    _refresh_plan = None
+    _wakeup = None
+    # set by stop(), ends blocking_sniffer or proxy
+    stopping = False
 
-    def __init__(self, drone_init=True, *args, **kwargs):
-        super(zSwarmDrone, self).__init__(*args, **kwargs)
-        self._methods = dict()
+    def __init__(self, *args, **kwargs):
+        super(zSwarmFollower, self).__init__(*args, **kwargs)
         self.master_book = dict()
-        if drone_init:
-            _adds, _fails, _deletes, _existing = self.refresh()
-            if _fails:
-                self.log.info("connected to %d masters (%d failed)",
-                              _adds, _fails)
-            else:
-                self.log.info("connected to %d masters", _adds)
-        self.register('_rollcall', self._rollcall)
+        self._refresh_lock = threading.Lock()
+        # zmq sockets belong to one thread, so the debounce timer only
+        # plans refreshes and pokes this pipe for the sniffer to apply them
+        self._wakeup = os.pipe()
 
-    def connect_master(self, mzep, minep, moutep):
+    def connect_master(self, mzep, minep, moutep,
+                       mctlinep=None, mctloutep=None):
         if mzep not in self.master_book:
             self.log.debug("connect_master -> mzep=%s minep=%s moutep=%s",
                            mzep, minep, moutep)
             # remember: published from master's perspective
             if self.connect(inep=moutep, outep=minep):
-                self.master_book[mzep] = (minep, moutep)
+                if mctlinep and self.control_lane:
+                    if not self.connect(inep=mctloutep, outep=mctlinep,
+                                        control=True):
+                        self.log.warn("%s control lane is not available",
+                                      mzep)
+                        mctlinep, mctloutep = None, None
+                else:
+                    mctlinep, mctloutep = None, None
+                self.master_book[mzep] = (minep, moutep, mctlinep, mctloutep)
                 return True
             else:
                 self.log.warn("%s is not available", mzep)
@@ -55,9 +85,11 @@ class zSwarmDrone(zSwarmPrimitive):
     def disconnect_master(self, mzep):
         if mzep in self.master_book:
             # remember: published from master's perspective
-            moutep, minep = self.master_book[mzep]
+            minep, moutep, mctlinep, mctloutep = self.master_book[mzep]
             self.log.debug("disconnect_master -> mzep=%s minep=%s moutep=%s",
                            mzep, minep, moutep)
+            if mctlinep:
+                self.disconnect(inep=mctloutep, outep=mctlinep, control=True)
             if self.disconnect(inep=moutep, outep=minep):
                 del self.master_book[mzep]
                 return True
@@ -68,55 +100,301 @@ class zSwarmDrone(zSwarmPrimitive):
                 del self.master_book[mzep]
                 return False
 
+    def upstreams(self):
+        "zookeeper nodes of whatever we should be connected to, watched"
+        _cs = self.zk.get_children('/masters', watch=self.zkchange)
+        return ['/masters/%s' % _c for _c in _cs]
+
     def refresh(self):
+        "catch up with zookeeper, from the thread that owns the sockets"
+        return self.apply_refresh(*self.plan_refresh())
+
+    def plan_refresh(self):
+        "(upstreams, endpoints of the new ones), without touching sockets"
+        _update = set(self.upstreams())
+        # keys() copies in one go, the sniffer may be changing the book
+        _to_add = _update.difference(self.master_book.keys())
+        # all the new endpoints in one round trip, not one per master
+        _pending = [(_a_ep, self.zk.get_async(_a_ep, watch=self.zkchange))
+                    for _a_ep in sorted(_to_add)]
+        _endpoints = dict()
+        for _a_ep, _async in _pending:
+            try:
+                val, stat = _async.get()
+            except NoNodeError:
+                self.log.debug("new upstream %s already gone", _a_ep)
+                _endpoints[_a_ep] = None
+                continue
+            _endpoints[_a_ep] = msgpack.unpackb(val)
+        return _update, _endpoints
+
+    def apply_refresh(self, update, endpoints):
+        "connect to upstreams in update and disconnect from the rest"
         _adds, _fails, _deletes, _existing = 0, 0, 0, 0
         _ex = set(self.master_book)
-        _cs = self.zk.get_children('/masters', watch=self.zkchange)
-        _update = set(['/masters/%s' % _c for _c in _cs])
-        _to_delete = _ex - _update
-        _to_add = _update - _ex
-        _no_change = _ex ^ _update
-        _existing = len(_no_change)
-        for _d_ep in _to_delete:
-            self.log.info("deleting gone master %s", _d_ep)
+        _existing = len(_ex & update)
+        for _d_ep in _ex - update:
+            self.log.info("deleting gone upstream %s", _d_ep)
             self.disconnect_master(_d_ep)
             _deletes += 1
-        for _a_ep in _to_add:
-            self.log.info("adding new master %s", _a_ep)
-            val, stat = self.zk.get(_a_ep, watch=self.zkchange)
-            minep, moutep = msgpack.unpackb(val)
-            if self.connect_master(_a_ep, minep, moutep):
+        for _a_ep in sorted(update - _ex):
+            if _a_ep not in endpoints:
+                # the book changed after this was planned, plan again
+                self.schedule_refresh()
+                continue
+            _eps = endpoints[_a_ep]
+            if _eps is None:
+                continue
+            self.log.info("adding new upstream %s", _a_ep)
+            # (in, out) or (in, out, control in, control out), and relays
+            # tack their locality on the end
+            if self.connect_master(_a_ep, *_eps[:4]):
                 _adds += 1
             else:
                 _fails += 1
         return _adds, _fails, _deletes, _existing
 
+    def schedule_refresh(self):
+        "fold a burst of /masters events into one refresh"
+        with self._refresh_lock:
+            self._refresh_events += 1
+            if self._refresh_timer is None:
+                self._refresh_since = time.time()
+                self._refresh_timer = threading.Timer(self.refresh_debounce,
+                                                      self._debounced_refresh)
+                self._refresh_timer.daemon = True
+                self._refresh_timer.start()
+
+    def _debounced_refresh(self):
+        with self._refresh_lock:
+            _since, _events = self._refresh_since, self._refresh_events
+            self._refresh_timer = None
+            self._refresh_events = 0
+        _plan = self.plan_refresh()
+        with self._refresh_lock:
+            if self._refresh_plan is not None:
+                # still not carried out, this one supersedes it
+                _since = min(_since, self._refresh_plan[0])
+                _events += self._refresh_plan[1]
+            self._refresh_plan = (_since, _events, _plan)
+        os.write(self._wakeup[1], '\0')
+
+    def stop(self):
+        "have blocking_sniffer or proxy return, from any thread"
+        self.stopping = True
+        os.write(self._wakeup[1], '\0')
+
+    def close(self):
+        super(zSwarmFollower, self).close()
+        for _fd in self._wakeup:
+            os.close(_fd)
+
+    def wakeup_fd(self):
+        "poll this for planned refreshes, then call refresh_planned()"
+        return self._wakeup[0]
+
+    def refresh_planned(self, woken=False):
+        "carry out the refresh the debounce timer planned, if any"
+        if woken:
+            os.read(self._wakeup[0], 4096)
+        if self._refresh_plan is None:
+            return None
+        with self._refresh_lock:
+            _since, _events, _plan = self._refresh_plan
+            self._refresh_plan = None
+        _adds, _fails, _deletes, _existing = self.apply_refresh(*_plan)
+        self.last_convergence = time.time() - _since
+        self.log.info("masters settled in %0.5fs (%d events): "
+                      "+%d -%d =%d, %d failed", self.last_convergence,
+                      _events, _adds, _deletes, _existing, _fails)
+        return _adds, _fails, _deletes, _existing
+
     def zkchange(self, event):
         if event.state == KazooState.CONNECTED:
-            if event.type == EventType.DELETED:
-                if event.path in self.master_book:
-                    self.disconnect_master(event.path)
-            elif event.type == EventType.CHILD:
-                _adds, _fails, _deletes, _existing = self.refresh()
+            if event.type in (EventType.CREATED, EventType.DELETED,
+                              EventType.CHILD):
+                # never touch the sockets from the kazoo callback thread
+                # (or the debounce timer's, see refresh_planned)
+                self.schedule_refresh()
             else:
                 self.log.info("unhandled zkchange: %s", event)
 
+
+class zSwarmDrone(zSwarmFollower):
+    swarmtype = "drone"
+    # remember: {} is a static attribute
+    # which is not what you want
+    _methods = None
+    # messages pulled off the socket ahead of the one being handled,
+    # which is how cancels overtake the requests they cancel
+    readahead = 64
+    _backlog = None
+    _ctl_backlog = None
+    # how long, and how many, cancelled reply ids to remember
+    cancel_ttl = 60.0
+    cancel_memory = 4096
+    _cancelled = None
+    current_call = None
+    _sniffing = None
+    # replies bigger than this go out in pieces to callers that can take it
+    chunk_size = 1 << 20
+    # give up on a chunked reply when its caller goes quiet this long
+    credit_timeout = 5.0
+    _credits = None
+    # seconds between heartbeats, None for none
+    heartbeat_interval = 1.0
+    _last_heartbeat = 0
+    # method -> (max_batch, max_wait) for handlers taking lists of calls
+    _batched = None
+
+    def __init__(self, drone_init=True, report_shed=False, use_relays=False,
+                 locality=None, *args, **kwargs):
+        # cheap until a master advertises a control lane to connect to
+        kwargs.setdefault('control_lane', True)
+        super(zSwarmDrone, self).__init__(*args, **kwargs)
+        # go through one relay rather than connecting to every master,
+        # preferably one with the same locality
+        self.use_relays = use_relays
+        self.locality = locality
+        # tell masters about requests we drop for being past deadline,
+        # rather than leaving them to time out
+        self.report_shed = report_shed
+        self._backlog = collections.deque()
+        self._ctl_backlog = collections.deque()
+        self._cancelled = collections.OrderedDict()
+        # (replyto, uniqueaddr) -> chunks we may still send
+        self._credits = collections.Counter()
+        self._methods = dict()
+        self._batched = dict()
+        if drone_init:
+            _adds, _fails, _deletes, _existing = self.refresh()
+            if _fails:
+                self.log.info("connected to %d masters (%d failed)",
+                              _adds, _fails)
+            else:
+                self.log.info("connected to %d masters", _adds)
+        self.register('_rollcall', self._rollcall)
+        self.subscribe('_cancel')
+
+    def upstreams(self):
+        "a relay to go through if we can, every master if not"
+        if self.use_relays:
+            _relays = self.relays()
+            # stay put if we can, moving drones about isn't free
+            _current = [_zep for _zep in _relays if _zep in self.master_book]
+            if _current:
+                return _current[:1]
+            elif _relays:
+                # spread the drones over the relays that suit them
+                return [_relays[hash(self.id) % len(_relays)]]
+        return super(zSwarmDrone, self).upstreams()
+
+    def relays(self):
+        "zookeeper nodes of relays, those in our locality if any, watched"
+        try:
+            _cs = self.zk.get_children('/relays', watch=self.zkchange)
+        except NoNodeError:
+            # hear about the first relay to turn up
+            self.zk.exists('/relays', watch=self.zkchange)
+            return []
+        _zeps = ['/relays/%s' % _c for _c in sorted(_cs)]
+        if self.locality is None:
+            return _zeps
+        _pending = [(_zep, self.zk.get_async(_zep)) for _zep in _zeps]
+        _near = []
+        for _zep, _async in _pending:
+            try:
+                val, stat = _async.get()
+            except NoNodeError:
+                continue
+            if msgpack.unpackb(val)[4] == self.locality:
+                _near.append(_zep)
+        # a faraway relay still beats connecting to every master
+        return _near or _zeps
+
     def register(self, method, func):
-        _zep = "/api/%s" % method
-        _zep_me = "%s/%s" % (_zep, self.uniqueaddr())
-        self.zk.ensure_path(_zep)
-        self.log.debug("_zep_me: %s" % _zep_me)
-        self.zk.create(_zep_me, ephemeral=True)
-        self.subscribe(method)
-        self._methods[method] = func
-
-    def deregister(self, method, function):
-        _zep = "/api/%s" % method
-        _zep_me = "%s/%s" % (_zep, self.uniqueaddr)
-        if self._zkcontext.exists(_zep_me):
-            self._zkcontext.delete(_zep_me)
-        self.unsubscribe(method)
-        del self._methods[method]
+        return self.register_many({method: func})
+
+    def register_many(self, methods):
+        "register a {method: func} dict of RPC handlers in one go"
+        self.subscribe_many(methods)
+        try:
+            self._api_create(methods, self.uniqueaddr())
+        except Exception:
+            self.unsubscribe_many(methods)
+            raise
+        self._methods.update(methods)
+
+    def register_batch(self, method, func, max_batch=100, max_wait=0.005):
+        "register func to take up to max_batch calls of method at once"
+        # func gets a list of argument tuples and returns a list of
+        # results, one per call and in the same order
+        self.register(method, func)
+        self._batched[method] = (max_batch, max_wait)
+
+    def deregister(self, method, function=None):
+        return self.deregister_many([method])
+
+    def deregister_many(self, methods):
+        "deregister several RPC handlers in one go"
+        self._api_delete(methods, self.uniqueaddr())
+        self.unsubscribe_many(methods)
+        for method in methods:
+            self._methods.pop(method, None)
+            self._batched.pop(method, None)
+
+    def _api_create(self, methods, addr):
+        "advertise addr under /api/<method> for every method, atomically"
+        try:
+            _have = set(self.zk.get_children('/api'))
+        except NoNodeError:
+            self.zk.ensure_path('/api')
+            _have = set()
+        _missing = [method for method in methods if method not in _have]
+        if _missing:
+            _t = self.zk.transaction()
+            for method in _missing:
+                _t.create('/api/%s' % method)
+            if _txfailure(_t.commit()):
+                # somebody else created some of them first, fine
+                for method in _missing:
+                    self.zk.ensure_path('/api/%s' % method)
+        _t = self.zk.transaction()
+        for method in methods:
+            _zep_me = "/api/%s/%s" % (method, addr)
+            self.log.debug("_zep_me: %s" % _zep_me)
+            _t.create(_zep_me, ephemeral=True)
+        _failure = _txfailure(_t.commit())
+        if _failure:
+            raise _failure
+
+    def _api_delete(self, methods, addr):
+        "withdraw addr from /api/<method> for every method"
+        _zeps = ["/api/%s/%s" % (method, addr) for method in methods]
+        _t = self.zk.transaction()
+        for _zep_me in _zeps:
+            _t.delete(_zep_me)
+        if _txfailure(_t.commit()):
+            # some were already gone (expired session?), do the rest alone
+            for _zep_me in _zeps:
+                try:
+                    self.zk.delete(_zep_me)
+                except NoNodeError:
+                    pass
+
+    def handlers(self, method):
+        "(uniqueaddr, func) pairs answering method on these sockets"
+        if method in self._methods:
+            return [(self.uniqueaddr(), self._methods[method])]
+        return []
+
+    def shed(self, method, replyto, control=False):
+        "drop a request nobody is waiting for any more"
+        self.counters['shed'] += 1
+        if self.report_shed:
+            for _addr, _func in self.handlers(method):
+                self.publish_withid('', replyto, addr=_addr,
+                                    meta={'shed': True}, control=control)
 
     def _rollcall(self, method):
         if method in self._methods:
@@ -128,35 +406,258 @@ class zSwarmDrone(zSwarmPrimitive):
             # remain silent
             return None
 
+    def heartbeat_addrs(self):
+        "uniqueaddrs we heartbeat for"
+        return [self.uniqueaddr()]
+
+    def heartbeat(self):
+        "let masters know we're alive, if it's been a while"
+        if self.heartbeat_interval is None:
+            return
+        _now = time.time()
+        if _now - self._last_heartbeat < self.heartbeat_interval:
+            return
+        self._last_heartbeat = _now
+        # the control lane only reaches masters that have one
+        _control = all(_eps[2] for _eps in self.master_book.values())
+        for _addr in self.heartbeat_addrs():
+            self.publish_withid(None, topic=_addr, addr=_addr,
+                                meta={'hb': _now}, control=_control)
+
     def blocking_sniffer(self, sockalias=None):
         sockalias = sockalias or self.in_sock_type
         _logname = "%s.blocking_sniffer.%s" % (self.log.name, sockalias)
         _log = logging.getLogger(_logname)
         _log.debug("ALIVE")
+        self._sniffing = sockalias
+        _insocks = [self._aliases[sockalias]]
+        if self.control_lane:
+            _insocks.append(self._ctl_in_socket)
+        _poller = zmq.Poller()
+        for _sock in _insocks:
+            _poller.register(_sock, zmq.POLLIN)
+        for _sock in self._out_sockets:
+            _poller.register(_sock, zmq.POLLIN)
+        _poller.register(self.wakeup_fd(), zmq.POLLIN)
+        _wait = None
+        if self.heartbeat_interval is not None:
+            _wait = self.heartbeat_interval * 1000
+        while not self.stopping:
+            self.heartbeat()
+            self.refresh_planned()
+            if not (self._backlog or self._ctl_backlog):
+                _ready = dict(_poller.poll(_wait))
+                if self.wakeup_fd() in _ready:
+                    self.refresh_planned(woken=True)
+                if not any(_sock in _ready for _sock in _insocks):
+                    self.drain_subscriptions()
+                    continue
+            self.read_ahead(sockalias)
+            # the control lane always goes first
+            if self._ctl_backlog:
+                _rawmsglist, _meta = self._ctl_backlog.popleft()
+                self.dispatch(_rawmsglist, _meta, _log, control=True)
+            elif self._backlog:
+                _rawmsglist, _meta = self._backlog.popleft()
+                self.dispatch(_rawmsglist, _meta, _log)
+
+    def read_ahead(self, sockalias=None, greedy=False):
+        "pull waiting messages into the backlog, acting on cancels at once"
+        sockalias = sockalias or self.in_sock_type
+        self.drain_subscriptions()
+        _lanes = [(sockalias, self._backlog)]
+        if self.control_lane:
+            _lanes.insert(0, (self.ctl_in_sock_type, self._ctl_backlog))
+        for _alias, _backlog in _lanes:
+            _insock = self._aliases[_alias]
+            # greedy reads past the limit, so credit can't get stuck
+            # behind a full backlog
+            while (greedy or len(_backlog) < self.readahead) and \
+                    _insock.poll(0, zmq.POLLIN):
+                _rawmsglist, _meta = self.recv_frames(_alias)
+                if _rawmsglist is None:
+                    continue
+                elif len(_rawmsglist) == 3 and _rawmsglist[0] == '_cancel':
+                    self.note_cancelled(msgpack.unpackb(_rawmsglist[2]))
+                elif _meta and 'credit' in _meta and len(_rawmsglist) == 2:
+                    _addr, _replyto = _rawmsglist
+                    self._credits[(_replyto, _addr)] += _meta['credit']
+                else:
+                    _backlog.append((_rawmsglist, _meta))
+
+    def send_chunked(self, payload, replyto, addr, window, control=False):
+        "send a big reply in chunks, no further ahead than the caller allows"
+        _count = (len(payload) + self.chunk_size - 1) // self.chunk_size
+        _key = (replyto, addr)
+        self._credits[_key] += window
+        _view = memoryview(payload)
+        try:
+            for _index in xrange(_count):
+                _waited = time.time()
+                while self._credits[_key] <= 0:
+                    if replyto in self._cancelled:
+                        self.log.debug("%s cancelled mid-transfer", replyto)
+                        self.counters['cancelled'] += 1
+                        return False
+                    self.heartbeat()
+                    if time.time() - _waited > self.credit_timeout:
+                        self.log.warn("%s stopped granting credit at "
+                                      "chunk %d/%d", replyto, _index, _count)
+                        self.counters['stalled'] += 1
+                        return False
+                    # credit comes on the control lane when there is one
+                    self._wait_in(0.010)
+                    self.read_ahead(self._sniffing, greedy=True)
+                self._credits[_key] -= 1
+                _offset = _index * self.chunk_size
+                self.publish_withid(
+                    _view[_offset:_offset + self.chunk_size].tobytes(),
+                    replyto, addr=addr, control=control,
+                    meta={'c': _index, 'k': _count, 'z': len(payload),
+                          'o': _offset})
+            return True
+        finally:
+            del self._credits[_key]
+
+    def note_cancelled(self, replytos):
+        _now = time.time()
+        for _replyto in replytos:
+            self._cancelled[_replyto] = _now + self.cancel_ttl
+        while self._cancelled:
+            _replyto, _expiry = next(self._cancelled.iteritems())
+            if _expiry > _now and len(self._cancelled) <= self.cancel_memory:
+                break
+            del self._cancelled[_replyto]
+
+    def is_cancelled(self):
+        "whether the call being handled right now has been cancelled"
+        # for long-running handlers to check every so often
+        if self.current_call is None:
+            return False
+        # a handler that checks in is alive, whatever it's up to
+        self.heartbeat()
+        self.read_ahead(self._sniffing)
+        return self.current_call in self._cancelled
+
+    def _admit(self, method, replyto, meta, log, control):
+        "whether a call is still worth handling"
+        if replyto in self._cancelled:
+            log.debug("dropping cancelled %s for %s", method, replyto)
+            self.counters['cancelled'] += 1
+            return False
+        if meta and 'd' in meta and time.time() > meta['d']:
+            # the caller has already given up on it
+            log.debug("shedding %s for %s", method, replyto)
+            self.shed(method, replyto, control)
+            return False
+        return True
+
+    def respond(self, ret, replyto, addr, meta, control=False):
+        "send a handler's result back, in chunks if it's big"
+        _packed = msgpack.packb(ret)
+        if meta and meta.get('w') and len(_packed) > self.chunk_size:
+            self.send_chunked(_packed, replyto, addr, meta['w'], control)
+        else:
+            self.publish_withid(_packed, replyto, addr=addr, control=control)
+
+    def _wait_in(self, seconds):
+        "wait up to seconds for anything to arrive on our in sockets"
+        _poller = zmq.Poller()
+        for _sock in self._in_sockets:
+            _poller.register(_sock, zmq.POLLIN)
+        return bool(_poller.poll(seconds * 1000))
+
+    def _take_batch(self, method, calls, max_batch, log):
+        "move queued calls of method from the backlogs into calls"
+        for _backlog, _control in ((self._ctl_backlog, True),
+                                   (self._backlog, False)):
+            _keep = collections.deque()
+            while _backlog:
+                _rawmsglist, _meta = _backlog.popleft()
+                if len(calls) < max_batch and len(_rawmsglist) == 3 and \
+                        _rawmsglist[0] == method and _rawmsglist[2]:
+                    if self._admit(method, _rawmsglist[1], _meta, log,
+                                   _control):
+                        calls.append((_rawmsglist, _meta, _control))
+                else:
+                    _keep.append((_rawmsglist, _meta))
+            # everything else keeps its place in line
+            _backlog.extend(_keep)
+
+    def dispatch_batch(self, method, calls, log=None):
+        "gather calls of a batched method, then hand them over in one go"
+        _log = log or self.log
+        _max_batch, _max_wait = self._batched[method]
+        _until = time.time() + _max_wait
         while True:
-            _rawmsglist = self._aliases[sockalias].recv_multipart()
-            if len(_rawmsglist) == 3:
-                # oh, replyable
-                _topic, _replyto, _rawmsg = _rawmsglist
-                if _rawmsg:
-                    _method = _topic
-                    _mparg = msgpack.unpackb(_rawmsg)
-                    if _method in self._methods:
-                        _log.debug("found method: %s", _method)
-                        _ret = self._methods[_method](*_mparg)
+            self._take_batch(method, calls, _max_batch, _log)
+            _left = _until - time.time()
+            if len(calls) >= _max_batch or _left <= 0:
+                break
+            if self._wait_in(_left):
+                self.read_ahead(self._sniffing, greedy=True)
+        _args = [tuple(msgpack.unpackb(_rawmsglist[2]))
+                 for _rawmsglist, _meta, _control in calls]
+        _results = self._methods[method](_args)
+        self.counters['batches'] += 1
+        self.counters['batched'] += len(calls)
+        if _results is None or len(_results) != len(calls):
+            _log.error("batch handler for %s returned %s results for %d "
+                       "calls, not replying", method,
+                       'no' if _results is None else len(_results),
+                       len(calls))
+            return
+        _addr = self.uniqueaddr()
+        for (_rawmsglist, _meta, _control), _ret in zip(calls, _results):
+            _replyto = _rawmsglist[1]
+            if _replyto in self._cancelled:
+                _log.debug("%s cancelled in flight", _replyto)
+                self.counters['cancelled'] += 1
+            elif _ret is not None:
+                self.respond(_ret, _replyto, _addr, _meta, _control)
+        _log.debug("batch of %d %s calls", len(calls), method)
+
+    def dispatch(self, rawmsglist, meta, log=None, control=False):
+        _log = log or self.log
+        if len(rawmsglist) == 3:
+            # oh, replyable
+            _topic, _replyto, _rawmsg = rawmsglist
+            if _rawmsg:
+                _method = _topic
+                if not self._admit(_method, _replyto, meta, _log, control):
+                    return
+                if _method in self._batched:
+                    self.dispatch_batch(_method, [(rawmsglist, meta, control)],
+                                        _log)
+                    return
+                _mparg = msgpack.unpackb(_rawmsg)
+                _handlers = self.handlers(_method)
+                if _handlers:
+                    _log.debug("found method: %s", _method)
+                self.current_call = _replyto
+                try:
+                    for _addr, _func in _handlers:
+                        _ret = _func(*_mparg)
                         _log.debug("returned: %s", _ret)
-                        if _ret is not None:
+                        if _replyto in self._cancelled:
+                            _log.debug("%s cancelled in flight", _replyto)
+                            self.counters['cancelled'] += 1
+                            break
+                        elif _ret is not None:
                             _log.debug("replying to %s", _method)
-                            self.publish_withid(msgpack.packb(_ret), _replyto)
+                            self.respond(_ret, _replyto, _addr, meta,
+                                         control)
                         else:
                             _log.debug("remaning silent against %s", _method)
-                    else:
-                        # what did you do????
-                        _log.warn("MISSING METHOD:%s, ARG:%s", _method, _mparg)
-                    _log.debug("<TOPIC:%s><REPLY-TO:%s>%s",
-                               _topic, _replyto, _mparg)
-            elif len(_rawmsglist) == 2:
-                _topic, _rawmsg = _rawmsglist
-                _log.info("<TOPIC:%s>%s", _topic, _rawmsg)
-            else:
-                _log.warn("[?]%s", _rawmsglist)
+                finally:
+                    self.current_call = None
+                if not _handlers:
+                    # what did you do????
+                    _log.warn("MISSING METHOD:%s, ARG:%s", _method, _mparg)
+                _log.debug("<TOPIC:%s><REPLY-TO:%s>%s",
+                           _topic, _replyto, _mparg)
+        elif len(rawmsglist) == 2:
+            _topic, _rawmsg = rawmsglist
+            _log.info("<TOPIC:%s>%s", _topic, _rawmsg)
+        else:
+            _log.warn("[?]%s", rawmsglist)
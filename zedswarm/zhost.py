@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2013 Dave Carlson <thecubic@thecubic.net>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import uuid
+import logging
+from .zdrone import zSwarmDrone
+
+
+class zSwarmVirtualDrone(object):
+    "a drone identity that rides on a zSwarmDroneHost's sockets"
+    swarmtype = "drone"
+    id = None
+    name = None
+    host = None
+    uniqueaddr = lambda self: "%s=%s" % (self.swarmtype, self.id)
+    _methods = None
+
+    def __init__(self, host, identity=None, name=None):
+        self.host = host
+        self.id = identity or str(uuid.uuid4())
+        self.name = name or "%s.%s" % (host.name, self.id)
+        self.log = logging.getLogger("%s.%s" % (host.log.name, self.name))
+        self._methods = dict()
+
+    def register(self, method, func):
+        return self.register_many({method: func})
+
+    def register_many(self, methods):
+        "register a {method: func} dict of RPC handlers in one go"
+        self.host.subscribe_many(methods)
+        try:
+            self.host._api_create(methods, self.uniqueaddr())
+        except Exception:
+            self.host.unsubscribe_many(methods)
+            raise
+        self._methods.update(methods)
+        self.host._route(self, methods)
+
+    def deregister(self, method, function=None):
+        return self.deregister_many([method])
+
+    def deregister_many(self, methods):
+        "deregister several RPC handlers in one go"
+        self.host._api_delete(methods, self.uniqueaddr())
+        self.host.unsubscribe_many(methods)
+        self.host._unroute(self, methods)
+        for method in methods:
+            self._methods.pop(method, None)
+
+    def _rollcall(self, method):
+        if method in self._methods:
+            self.log.debug("grok %s" % method)
+            # send a null message
+            return ''
+        else:
+            self.log.debug("dunno %s" % method)
+            # remain silent
+            return None
+
+
+class zSwarmDroneHost(zSwarmDrone):
+    "a drone whose sockets and sniffer also serve many virtual drones"
+    # remember: {} is a static attribute
+    # which is not what you want
+    virtual_drones = None
+    _routes = None
+
+    def __init__(self, *args, **kwargs):
+        self.virtual_drones = dict()
+        # method -> {uniqueaddr: func}
+        self._routes = dict()
+        super(zSwarmDroneHost, self).__init__(*args, **kwargs)
+
+    def add_drone(self, identity=None, name=None):
+        "create a virtual drone hosted here"
+        _vd = zSwarmVirtualDrone(self, identity=identity, name=name)
+        self.virtual_drones[_vd.uniqueaddr()] = _vd
+        self.subscribe(_vd.uniqueaddr())
+        _vd.register('_rollcall', _vd._rollcall)
+        return _vd
+
+    def remove_drone(self, vdrone):
+        "deregister everything a virtual drone offers and forget it"
+        vdrone.deregister_many(list(vdrone._methods))
+        self.unsubscribe(vdrone.uniqueaddr())
+        del self.virtual_drones[vdrone.uniqueaddr()]
+
+    def _route(self, vdrone, methods):
+        _addr = vdrone.uniqueaddr()
+        for method in methods:
+            self._routes.setdefault(method, dict())[_addr] = methods[method]
+
+    def _unroute(self, vdrone, methods):
+        _addr = vdrone.uniqueaddr()
+        for method in methods:
+            _r = self._routes.get(method)
+            if _r is not None:
+                _r.pop(_addr, None)
+                if not _r:
+                    del self._routes[method]
+
+    def heartbeat_addrs(self):
+        return [self.uniqueaddr()] + self.virtual_drones.keys()
+
+    def handlers(self, method):
+        "(uniqueaddr, func) pairs answering method on these sockets"
+        _handlers = super(zSwarmDroneHost, self).handlers(method)
+        if method in self._routes:
+            _handlers.extend(self._routes[method].items())
+        return _handlers
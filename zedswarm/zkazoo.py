@@ -14,8 +14,11 @@
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
 
+import threading
 from kazoo.client import KazooClient
 from kazoo.protocol.states import *
+from kazoo.exceptions import KazooException, NoNodeError, NodeExistsError, \
+    NotEmptyError, RolledBackError
 
 
 class Singleton(type):
@@ -37,3 +40,209 @@ class Singleton(type):
 # singletons: the path of least resistance
 class KazooContext(KazooClient):
     __metaclass__ = Singleton
+
+
+class _LocalResult(object):
+    "an already-finished stand-in for kazoo's IAsyncResult"
+    def __init__(self, func, *args):
+        try:
+            self.value, self.exc = func(*args), None
+        except Exception as e:
+            self.value, self.exc = None, e
+
+    def ready(self):
+        return True
+
+    def successful(self):
+        return self.exc is None
+
+    def exception(self):
+        return self.exc
+
+    def get(self, block=True, timeout=None):
+        if self.exc is not None:
+            raise self.exc
+        return self.value
+
+    def get_nowait(self):
+        return self.get()
+
+
+class _LocalTransaction(object):
+    def __init__(self, client):
+        self.client = client
+        self.operations = []
+
+    def create(self, path, value=b'', acl=None, ephemeral=False,
+               sequence=False):
+        self.operations.append(('create', path, value, ephemeral))
+
+    def delete(self, path, version=-1):
+        self.operations.append(('delete', path))
+
+    def commit(self):
+        return self.client._commit(self.operations)
+
+
+class LocalKazoo(object):
+    "in-memory stand-in for a KazooClient, for swarms inside one process"
+    # remember: {} is a static attribute
+    # which is not what you want
+    state = KazooState.LOST
+    _nodes = None
+    _ephemeral = None
+    _child_watches = None
+    _data_watches = None
+
+    def __init__(self):
+        self._nodes = {'/': b''}
+        self._ephemeral = set()
+        self._child_watches = dict()
+        self._data_watches = dict()
+        self._lock = threading.RLock()
+        self.start()
+
+    def start(self, timeout=None):
+        self.state = KazooState.CONNECTED
+
+    def stop(self):
+        "like losing the session: ephemeral nodes go away"
+        for _path in sorted(self._ephemeral, reverse=True):
+            try:
+                self.delete(_path)
+            except NoNodeError:
+                pass
+        self.state = KazooState.LOST
+
+    def _parent(self, path):
+        return path.rsplit('/', 1)[0] or '/'
+
+    def _fire(self, watches, path, event_type):
+        # kazoo calls watchers from its own thread, and only once
+        _event = WatchedEvent(event_type, KazooState.CONNECTED, path)
+        for _watch in watches.pop(path, ()):
+            _t = threading.Thread(target=_watch, args=(_event,))
+            _t.daemon = True
+            _t.start()
+
+    def _create(self, path, value=b'', ephemeral=False):
+        if path in self._nodes:
+            raise NodeExistsError()
+        if self._parent(path) not in self._nodes:
+            raise NoNodeError()
+        self._nodes[path] = value
+        if ephemeral:
+            self._ephemeral.add(path)
+
+    def _delete(self, path):
+        if path not in self._nodes:
+            raise NoNodeError()
+        _prefix = path.rstrip('/') + '/'
+        if any(_path.startswith(_prefix) for _path in self._nodes):
+            raise NotEmptyError()
+        del self._nodes[path]
+        self._ephemeral.discard(path)
+
+    def create(self, path, value=b'', acl=None, ephemeral=False,
+               sequence=False, makepath=False):
+        with self._lock:
+            if makepath:
+                self.ensure_path(self._parent(path))
+            self._create(path, value, ephemeral)
+        self._fire(self._data_watches, path, EventType.CREATED)
+        self._fire(self._child_watches, self._parent(path), EventType.CHILD)
+        return path
+
+    def delete(self, path, version=-1, recursive=False):
+        with self._lock:
+            if recursive:
+                for _child in self.get_children(path):
+                    self.delete("%s/%s" % (path.rstrip('/'), _child),
+                                recursive=True)
+            self._delete(path)
+        self._fire(self._data_watches, path, EventType.DELETED)
+        self._fire(self._child_watches, self._parent(path), EventType.CHILD)
+        return True
+
+    def _commit(self, operations):
+        "all or nothing, like a real multi-op"
+        _results = []
+        _undo = []
+        with self._lock:
+            for _op in operations:
+                try:
+                    if _op[0] == 'create':
+                        self._create(_op[1], _op[2], _op[3])
+                        _undo.append(('delete', _op[1]))
+                        _results.append(_op[1])
+                    else:
+                        _value = self._nodes.get(_op[1])
+                        _ephemeral = _op[1] in self._ephemeral
+                        self._delete(_op[1])
+                        _undo.append(('create', _op[1], _value, _ephemeral))
+                        _results.append(True)
+                except Exception as e:
+                    for _done in reversed(_undo):
+                        if _done[0] == 'delete':
+                            self._delete(_done[1])
+                        else:
+                            self._create(_done[1], _done[2], _done[3])
+                    _results = [RolledBackError() for _res in _results]
+                    _results.append(e)
+                    _results.extend(RolledBackError()
+                                    for _rest in operations[len(_results):])
+                    return _results
+        for _op in operations:
+            self._fire(self._data_watches, _op[1], EventType.CREATED
+                       if _op[0] == 'create' else EventType.DELETED)
+            self._fire(self._child_watches, self._parent(_op[1]),
+                       EventType.CHILD)
+        return _results
+
+    def transaction(self):
+        return _LocalTransaction(self)
+
+    def ensure_path(self, path, acl=None):
+        _path = ''
+        for _part in path.strip('/').split('/'):
+            _path += '/' + _part
+            if _path not in self._nodes:
+                try:
+                    self.create(_path)
+                except NodeExistsError:
+                    pass
+        return True
+
+    def exists(self, path, watch=None):
+        if watch is not None:
+            self._data_watches.setdefault(path, []).append(watch)
+        # no ZnodeStat to hand back, but it's truthy where it matters
+        return True if path in self._nodes else None
+
+    def get(self, path, watch=None):
+        with self._lock:
+            if path not in self._nodes:
+                raise NoNodeError()
+            if watch is not None:
+                self._data_watches.setdefault(path, []).append(watch)
+            return self._nodes[path], None
+
+    def get_children(self, path, watch=None, include_data=False):
+        with self._lock:
+            if path not in self._nodes:
+                raise NoNodeError()
+            if watch is not None:
+                self._child_watches.setdefault(path, []).append(watch)
+            _prefix = path.rstrip('/') + '/'
+            return [_path[len(_prefix):] for _path in self._nodes
+                    if _path.startswith(_prefix) and
+                    '/' not in _path[len(_prefix):]]
+
+    def get_async(self, path, watch=None):
+        return _LocalResult(self.get, path, watch)
+
+    def get_children_async(self, path, watch=None, include_data=False):
+        return _LocalResult(self.get_children, path, watch)
+
+    def exists_async(self, path, watch=None):
+        return _LocalResult(self.exists, path, watch)
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2013 Dave Carlson <thecubic@thecubic.net>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import collections
+
+
+class LatencyEstimate(object):
+    "reply latency of one provider for one method"
+    srtt = None
+    rttvar = None
+    # deadlines missed in a row
+    misses = 0
+    _samples = None
+
+    def __init__(self, samples):
+        self._samples = collections.deque(maxlen=samples)
+
+    def observe(self, seconds, alpha, beta):
+        if self.srtt is None:
+            self.srtt = seconds
+            self.rttvar = seconds / 2.0
+        else:
+            # same smoothing TCP uses for its retransmit timer
+            self.rttvar += beta * (abs(self.srtt - seconds) - self.rttvar)
+            self.srtt += alpha * (seconds - self.srtt)
+        self.misses = 0
+        self._samples.append(seconds)
+
+    def count(self):
+        return len(self._samples)
+
+    def percentile(self, q):
+        "q-th quantile (0..1) of the recent samples"
+        if not self._samples:
+            return None
+        _sorted = sorted(self._samples)
+        return _sorted[min(len(_sorted) - 1, int(q * len(_sorted)))]
+
+    def rto(self, q, backoff_cap):
+        "how long to wait before giving up on this provider"
+        _rto = max(self.srtt + 4 * self.rttvar, self.percentile(q))
+        return _rto * (2 ** min(self.misses, backoff_cap))
+
+
+class LatencyTracker(object):
+    "rolling reply latencies per (method, provider), for picking deadlines"
+    alpha = 0.125
+    beta = 0.25
+    # ring of raw samples kept per provider for percentiles
+    samples = 128
+    # samples needed before an estimate is trusted
+    min_samples = 3
+    # quantile a deadline has to cover
+    quantile = 0.99
+    # doublings of the deadline for a provider that keeps missing it
+    backoff_cap = 4
+    # missed deadlines in a row before a provider counts as an outlier
+    miss_limit = 3
+    # times slower than the median of its peers to count as an outlier
+    outlier_factor = 4.0
+    # bounds on computed deadlines
+    floor = 0.010
+    ceiling = 30.0
+    _estimates = None
+
+    def __init__(self):
+        # method -> {provider: LatencyEstimate}
+        self._estimates = collections.defaultdict(dict)
+
+    def observe(self, method, provider, seconds):
+        _est = self._estimates[method].get(provider)
+        if _est is None:
+            _est = LatencyEstimate(self.samples)
+            self._estimates[method][provider] = _est
+        _est.observe(seconds, self.alpha, self.beta)
+
+    def missed(self, method, provider):
+        "provider didn't answer in time, returns its misses in a row"
+        _est = self._estimates[method].get(provider)
+        if _est is None:
+            _est = LatencyEstimate(self.samples)
+            self._estimates[method][provider] = _est
+        _est.misses += 1
+        return _est.misses
+
+    def forget(self, provider):
+        for _providers in self._estimates.itervalues():
+            _providers.pop(provider, None)
+
+    def retain(self, method, providers):
+        "forget providers of method that aren't among providers"
+        _ests = self._estimates.get(method)
+        if _ests:
+            for _provider in set(_ests).difference(providers):
+                del _ests[_provider]
+
+    def estimate(self, method, provider):
+        "(smoothed latency, deviation), or None until there's enough to go on"
+        _est = self._estimates.get(method, {}).get(provider)
+        if _est is None or _est.count() < self.min_samples:
+            return None
+        return _est.srtt, _est.rttvar
+
+    def percentile(self, method, provider, q):
+        _est = self._estimates.get(method, {}).get(provider)
+        if _est is None:
+            return None
+        return _est.percentile(q)
+
+    def _rtos(self, method, providers=None):
+        _ests = self._estimates.get(method, {})
+        if providers is None:
+            providers = _ests.keys()
+        _rtos = dict()
+        for _provider in providers:
+            _est = _ests.get(_provider)
+            if _est is not None and _est.count() >= self.min_samples:
+                _rtos[_provider] = _est.rto(self.quantile, self.backoff_cap)
+        return _rtos
+
+    def unresponsive(self, method, providers=None):
+        "providers that keep missing their deadlines"
+        _ests = self._estimates.get(method, {})
+        if providers is None:
+            providers = _ests.keys()
+        return set(_provider for _provider in providers
+                   if _provider in _ests and
+                   _ests[_provider].misses >= self.miss_limit)
+
+    def outliers(self, method, providers=None):
+        "providers that keep missing deadlines or lag well behind their peers"
+        _out = self.unresponsive(method, providers)
+        _rtos = self._rtos(method, providers)
+        if len(_rtos) >= 3:
+            _sorted = sorted(_rtos.itervalues())
+            _median = _sorted[len(_sorted) // 2]
+            _out.update(_provider for _provider, _rto in _rtos.iteritems()
+                        if _rto > self.outlier_factor * _median)
+        return _out
+
+    def timeout(self, method, providers=None):
+        "seconds to wait on providers for method, None if we can't say yet"
+        # slow is fine, they get waited on; silent is not
+        _lost = self.unresponsive(method, providers)
+        _rtos = self._rtos(method, providers)
+        if providers is not None:
+            # anybody we know nothing about gets the default instead
+            if any(_provider not in _rtos and _provider not in _lost
+                   for _provider in providers):
+                return None
+        _waits = [_rto for _provider, _rto in _rtos.iteritems()
+                  if _provider not in _lost]
+        if not _waits:
+            return None
+        return min(self.ceiling, max(self.floor, max(_waits)))
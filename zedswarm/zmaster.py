@@ -17,16 +17,275 @@
 import msgpack
 import time
 import copy
+import collections
+import mmap
+import tempfile
 from .zprimitive import zSwarmPrimitive
+from .zlatency import LatencyTracker
+from .zkazoo import KazooState, KazooException, NoNodeError
+
+
+class zSwarmTransfer(object):
+    "reassembly buffer for one chunked reply"
+    size = 0
+    count = 0
+    received = 0
+    # chunks taken in since we last handed out credit
+    unacked = 0
+
+    def __init__(self, size, count, spool_threshold=None):
+        self.size = size
+        self.count = count
+        if spool_threshold is not None and size >= spool_threshold:
+            # big enough to live in the page cache rather than the heap
+            self._file = tempfile.TemporaryFile()
+            self._file.truncate(size)
+            self.buffer = mmap.mmap(self._file.fileno(), size)
+        else:
+            self.buffer = bytearray(size)
+
+    def put(self, offset, chunk):
+        self.buffer[offset:offset + len(chunk)] = chunk
+        self.received += 1
+
+    def complete(self):
+        return self.received >= self.count
+
+
+def _unpackable(payload):
+    "payload as something msgpack reads in place without complaint"
+    if isinstance(payload, mmap.mmap):
+        # the old buffer protocol is all a python 2 mmap speaks, and
+        # msgpack warns about unpacking from it directly
+        return buffer(payload)
+    return payload
+
+
+class zSwarmCall(object):
+    "an RPC in flight: iterate it for replies, cancel or close it when done"
+    master = None
+    id = None
+    providers = None
+    remaining = None
+    closed = False
+    cancelled = False
+    _held = None
+
+    def __init__(self, master, method, args, providers=None, only=False,
+                 timeout=None, sockname=None, control=False, window=None,
+                 raw=False):
+        self.master = master
+        self.method = method
+        # no providers means take whatever answers until the deadline
+        self.providers = providers
+        if providers is not None:
+            self.remaining = set(providers)
+        self.only = only
+        # small urgent calls can skip the bulk queue on the control lane
+        self.control = control
+        self.sockname = sockname or master.lane_alias(control)
+        self.arity = 3 if providers is not None else None
+        self.timeout = timeout or master.timeout
+        self.started = time.time()
+        self.deadline = self.started + self.timeout
+        # chunks a drone may have in flight to us per reply, 0 for no
+        # chunking at all; raw hands back payloads without unpacking
+        self.window = master.chunk_window if window is None else window
+        self.raw = raw
+        self._transfers = dict()
+        _mpargs = msgpack.packb(args)
+        master.log.debug("MPARGS: '%s' -> '%s'", args, _mpargs)
+        self.id, _subscribe, _send = master.publish_replyable(
+            _mpargs, topic=method, deadline=self.deadline, control=control,
+            meta={'w': self.window} if self.window else None)
+        # replies other calls read for us wait here
+        self._held = master._open_calls[self.id] = collections.deque()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.finish()
+
+    def __del__(self):
+        if not self.closed:
+            try:
+                self.close()
+            except Exception:
+                pass
+
+    def _incoming(self):
+        "replies held for us, then whatever is waiting on the socket"
+        while self._held:
+            yield self._held.popleft()
+        for _rawmsglist, _meta in self.master.generate_recv(
+                self.sockname, arity=self.arity, meta=True):
+            if _rawmsglist[0] != self.id:
+                self.master.hold_reply(_rawmsglist, _meta)
+                continue
+            yield _rawmsglist, _meta
+
+    def __iter__(self):
+        try:
+            while not self.done():
+                for _rawmsglist, _meta in self._incoming():
+                    _res = self._reply(_rawmsglist, _meta)
+                    if _res is not None:
+                        yield _res
+                    if self.done():
+                        break
+        finally:
+            # also reached when the caller walks away mid-iteration
+            self.finish()
+
+    def _reply(self, rawmsglist, meta):
+        _provider = rawmsglist[1]
+        if self.master._was_shed(rawmsglist, meta):
+            # it isn't going to answer, stop waiting on it
+            if self.remaining is not None:
+                self.remaining.discard(_provider)
+            return None
+        if meta and 'k' in meta:
+            rawmsglist = self._chunk(rawmsglist, meta)
+            if rawmsglist is None:
+                return None
+        else:
+            self._observe(_provider)
+        # an answer is as good as a heartbeat
+        self.master.seen(_provider)
+        if self.remaining is not None:
+            _size = len(rawmsglist[2])
+            if _provider in self.remaining:
+                self.master.log.debug("REG: <FROM:%s><%d bytes>",
+                                      _provider, _size)
+                self.remaining.remove(_provider)
+            elif _provider in self.providers:
+                self.master.log.debug("MULTI: <FROM:%s><%d bytes>",
+                                      _provider, _size)
+                if self.only:
+                    return None
+            else:
+                self.master.log.debug("UNREG: <FROM:%s><%d bytes>",
+                                      _provider, _size)
+                if self.only:
+                    return None
+        _res = rawmsglist[1:]
+        if len(_res) == 2:
+            if self.raw:
+                return _res[0], _res[1]
+            return _res[0], msgpack.unpackb(_unpackable(_res[1]))
+        else:
+            return _res[0]
+
+    def _chunk(self, rawmsglist, meta):
+        "file a chunk away, returning the whole message once it's all in"
+        _provider, _chunk = rawmsglist[1], rawmsglist[2]
+        _xfer = self._transfers.get(_provider)
+        if _xfer is None:
+            # first chunk in is as good as an answer, latency-wise
+            self._observe(_provider)
+            _xfer = zSwarmTransfer(meta['z'], meta['k'],
+                                   self.master.spool_threshold)
+            self._transfers[_provider] = _xfer
+        _xfer.put(meta['o'], _chunk)
+        # a transfer that's still moving shouldn't time out under us
+        self.deadline = max(self.deadline, time.time() + self.timeout)
+        if _xfer.complete():
+            del self._transfers[_provider]
+            return [rawmsglist[0], _provider, _xfer.buffer]
+        _xfer.unacked += 1
+        if _xfer.unacked * 2 >= self.window:
+            # the drone only sends as far ahead as we say
+            self.master.publish_withid(None, topic=_provider, addr=self.id,
+                                       meta={'credit': _xfer.unacked},
+                                       control=True)
+            _xfer.unacked = 0
+        return None
+
+    def _observe(self, provider):
+        if self.remaining is None or provider in self.remaining:
+            self.master.latency.observe(self.method, provider,
+                                        time.time() - self.started)
+
+    def answered(self):
+        "every expected provider has replied"
+        return self.remaining is not None and not self.remaining
+
+    def done(self):
+        if self.closed:
+            return True
+        elif self.answered():
+            self.master.log.debug("Everybody responded, nice")
+            return True
+        elif time.time() > self.deadline:
+            self.master.log.debug("no timeleft")
+            return True
+        return False
+
+    def close(self):
+        "stop listening for replies"
+        if not self.closed:
+            self.closed = True
+            self.master._open_calls.pop(self.id, None)
+            self.master.unsubscribe(self.id, control=self.control)
+
+    def cancel(self):
+        "tell drones to drop this call, then stop listening for it"
+        if not self.closed:
+            self.cancelled = True
+            self.master.publish_withid(msgpack.packb([self.id]),
+                                       topic='_cancel', control=True)
+            self.close()
+
+    def finish(self):
+        "close if the call ran its course, cancel if it was cut short"
+        if not self.closed:
+            if self.answered() or time.time() > self.deadline:
+                for _provider in self.remaining or ():
+                    self.master.missed(self.method, _provider)
+                self.close()
+            else:
+                self.cancel()
 
 
 class zSwarmMaster(zSwarmPrimitive):
     swarmtype = "master"
     rpc_defaults = None
     _system_methods = None
+    _rc_cache = None
+    # reply id -> replies held for that open call
+    _open_calls = None
+    latency = None
+    _last_seen = None
+    _first_listed = None
+    # forget providers unheard from for this many heartbeat timeouts
+    forget_timeouts = 10
+    _last_swept = 0
+    # drones heartbeat on their uniqueaddr
+    heartbeat_topic = 'drone='
+    # seconds a rollcall result is reused for
+    rc_cache_ttl = 5.0
+    # minimum wait for rollcall stragglers after the first reply
+    rc_settle = 0.005
+    # chunks of one large reply a drone may send before we grant more
+    chunk_window = 8
+    # reassemble replies at least this big in a file-backed mmap
+    spool_threshold = 64 << 20
 
-    def __init__(self, bind_vector=None, *args, **kwargs):
+    def __init__(self, bind_vector=None, control_vector=None,
+                 heartbeat_timeout=None, *args, **kwargs):
+        if control_vector:
+            kwargs['control_lane'] = True
         super(zSwarmMaster, self).__init__(*args, **kwargs)
+        # providers not heard from for this long are left out of lookups,
+        # None to trust zookeeper alone
+        self.heartbeat_timeout = heartbeat_timeout
+        # uniqueaddr -> when we last knew it to be alive
+        self._last_seen = dict()
+        # uniqueaddr -> when a lookup first turned it up
+        self._first_listed = dict()
+        if heartbeat_timeout is not None:
+            self.subscribe(self.heartbeat_topic, prefix=True)
         self._system_methods = ['bind', 'connect', 'generate_recv',
                                 'pollsocks', 'pollwrap', 'publish',
                                 'publish_replyable', 'publish_withid',
@@ -35,16 +294,26 @@ class zSwarmMaster(zSwarmPrimitive):
                                 'uniqueaddr', 'uniquesub', 'unsubscribe',
                                 'set_rpc_defaults', 'update_rpc_defaults']
         self.rpc_defaults = {'certain': True, 'generator': True}
+        self._rc_cache = dict()
+        self._open_calls = dict()
+        self.latency = LatencyTracker()
         if bind_vector:
-            self.bind(*bind_vector)
+            self.bind(*bind_vector, control_vector=control_vector)
 
-    def bind(self, pub_inep, priv_inep, pub_outep, priv_outep):
+    def bind(self, pub_inep, priv_inep, pub_outep, priv_outep,
+             control_vector=None):
         self.zk.ensure_path('/%ss' % self.swarmtype)
         _zep_me = "/%ss/%s" % (self.swarmtype, self.uniqueaddr())
         _bo = self._out_socket.bind(priv_outep)
         _bi = self._in_socket.bind(priv_inep)
-        _zk = self.zk.create(_zep_me,
-                             value=msgpack.packb((pub_inep, pub_outep)),
+        _value = (pub_inep, pub_outep)
+        if control_vector:
+            # same layout as bind_vector, for the control lane
+            _cpub_inep, _cpriv_inep, _cpub_outep, _cpriv_outep = control_vector
+            self._ctl_out_socket.bind(_cpriv_outep)
+            self._ctl_in_socket.bind(_cpriv_inep)
+            _value += (_cpub_inep, _cpub_outep)
+        _zk = self.zk.create(_zep_me, value=msgpack.packb(_value),
                              ephemeral=True)
         return _bo, _bi, _zk
 
@@ -79,188 +348,249 @@ class zSwarmMaster(zSwarmPrimitive):
         else:
             return self.__dict__[method]
 
+    def hold_reply(self, rawmsglist, meta):
+        "keep a reply for the open call it's for, read by another"
+        _held = self._open_calls.get(rawmsglist[0])
+        if _held is None:
+            self.stray(rawmsglist)
+        else:
+            _held.append((rawmsglist, meta))
+
+    def intercept(self, frames, meta):
+        if meta and 'hb' in meta and len(frames) == 2:
+            # our clock, not the drone's: they needn't agree
+            self.seen(frames[0])
+            return True
+        return False
+
+    def seen(self, provider, when=None):
+        "note provider as alive at when, or now"
+        if self.heartbeat_timeout is None:
+            # nobody's going to ask
+            return
+        when = when or time.time()
+        if when > self._last_seen.get(provider, 0):
+            self._last_seen[provider] = when
+
+    def alive(self, providers):
+        "providers, less those whose heartbeat has gone stale"
+        if self.heartbeat_timeout is None:
+            return providers
+        # heartbeats pile up unread while we're idle, and drones that
+        # connected meanwhile only get our subscription once we touch
+        # the socket
+        self.catch_up()
+        _now = time.time()
+        _cutoff = _now - self.heartbeat_timeout
+        for _provider in providers:
+            self._first_listed.setdefault(_provider, _now)
+        # no heartbeat yet is only suspicious once we've known about a
+        # provider long enough to have heard one
+        _alive = [_provider for _provider in providers
+                  if self._last_seen.get(
+                      _provider, self._first_listed[_provider]) >= _cutoff]
+        if len(_alive) < len(providers):
+            self.log.debug("stale heartbeats from %s",
+                           sorted(set(providers).difference(_alive)))
+            self.counters['stale'] += len(providers) - len(_alive)
+        if _now - self._last_swept > self.heartbeat_timeout:
+            self._last_swept = _now
+            self.forget_gone(providers, _now)
+        return _alive
+
+    def forget(self, provider):
+        "drop everything we know about a provider"
+        self.latency.forget(provider)
+        self._last_seen.pop(provider, None)
+        self._first_listed.pop(provider, None)
+
+    def forget_gone(self, listed=(), now=None):
+        "forget providers long silent, restarted drones come back as new ones"
+        now = now or time.time()
+        _cutoff = now - self.forget_timeouts * self.heartbeat_timeout
+        _listed = set(listed)
+        _gone = [_provider for _provider in
+                 set(self._last_seen).union(self._first_listed)
+                 if _provider not in _listed and
+                 self._last_seen.get(_provider,
+                                     self._first_listed.get(_provider)) <
+                 _cutoff]
+        for _provider in _gone:
+            self.forget(_provider)
+        if _gone:
+            self.log.debug("forgot %d silent providers", len(_gone))
+        return _gone
+
     def get_providers(self, signature, *args, **kwargs):
         "get RPC handlers through zookeeper"
         _zkep = '/api/%s' % signature
         if self.zk.exists(_zkep):
-            return self.zk.get_children(_zkep)
-        else:
-            raise NameError("no providers of %s" % signature)
+            _listed = self.zk.get_children(_zkep)
+            # providers gone from zookeeper aren't coming back
+            self.latency.retain(signature, _listed)
+            _providers = self.alive(_listed)
+            if _providers:
+                return _providers
+        raise NameError("no providers of %s" % signature)
 
-    def get_providers_rc(self, signature, maxp=0,
-                         timeout=None, sockname=None):
-        "probe and generate RPC handlers through rollcall method"
-        sockname = sockname or self.in_sock_type
+    def get_providers_rc(self, signature, maxp=0, timeout=None,
+                         sockname=None, crosscheck=False, cached=True):
+        "probe RPC handlers through rollcall method"
+        if cached and signature in self._rc_cache:
+            _stamp, _providers = self._rc_cache[signature]
+            if time.time() - _stamp < self.rc_cache_ttl:
+                return list(_providers)
+        # rollcall rides the control lane when there is one
+        sockname = sockname or self.lane_alias(True)
+        _control = sockname == self.lane_alias(True)
         timeout = timeout or self.timeout
+        _zkres = None
+        if crosscheck:
+            # in flight while we wait for drones to speak up
+            _zkres = self.zk.get_children_async('/api/%s' % signature)
+        _expected = None
         _mpsig = msgpack.packb([signature])
-        _pr = self.publish_replyable(_mpsig, topic="_rollcall")
-        _id, _subscribe, _send = _pr
-        _providers = []
         timestart = time.time()
-        remaining = maxp
-        while True:
-            timeleft = time.time() - timestart - timeout
-            if timeleft > 0:
-                self.log.debug("no timeleft")
-                self.unsubscribe(_id)
-                if not _providers:
-                    raise NameError("no providers of %s" % signature)
-                else:
-                    raise StopIteration
-            elif maxp and not remaining:
-                self.log.debug("max number hit")
-                self.unsubscribe(_id)
-                raise StopIteration
-            else:
-                for _rawmsglist in self.generate_recv(sockname):
+        deadline = timestart + timeout
+        _id, _subscribe, _send = self.publish_replyable(_mpsig,
+                                                        topic="_rollcall",
+                                                        deadline=deadline,
+                                                        control=_control)
+        _providers = []
+        settle = None
+        try:
+            while time.time() < deadline:
+                if maxp and len(_providers) >= maxp:
+                    self.log.debug("max number hit")
+                    break
+                if _zkres is not None and _zkres.ready():
+                    try:
+                        _expected = set(_zkres.get())
+                    except NoNodeError:
+                        _expected = set()
+                    except KazooException as e:
+                        self.log.warn("rollcall crosscheck failed: %s", e)
+                    _zkres = None
+                if _expected and _expected.issubset(_providers):
+                    self.log.debug("everybody in zookeeper answered")
+                    break
+                for _rawmsglist, _meta in self.generate_recv(
+                        sockname, arity=3, meta=True):
+                    if _rawmsglist[0] != _id:
+                        self.hold_reply(_rawmsglist, _meta)
+                        continue
+                    _provider = _rawmsglist[1]
+                    if _provider in _providers:
+                        continue
                     self.log.debug("capable of '%s': %s" % (signature,
-                                                            _rawmsglist[1]))
-                    _providers.append(_rawmsglist[1])
-                    if maxp:
-                        remaining -= 1
-                    yield _rawmsglist[1]
-        for _rawmsglist in self.generate_recv(sockname):
-            _rawmsglist = self._aliases[sockname].recv_multipart()
-            self.log.debug("capable of '%s': %s" % (signature, _rawmsglist[1]))
-            _providers.append(_rawmsglist[1])
-            if maxp:
-                remaining -= 1
-            yield _rawmsglist[1]
-        raise StopIteration
-
-    def get_providers_all(self, *args, **kwargs):
-        return [provider for provider in self.get_providers(*args, **kwargs)]
-
-    def request_response(self, method, args, timeout=None, sockname=None):
-        "generator of responses to an RPC-like call"
-        sockname = sockname or self.in_sock_type
-        timeout = timeout or self.timeout
-        _mpargs = msgpack.packb(args)
-        self.log.debug("MPARGS: '%s' -> '%s'" % (args, _mpargs))
-        _id, _subscribe, _send = self.publish_replyable(_mpargs, topic=method)
-        timestart = time.time()
-        while True:
-            timeleft = time.time() - timestart - timeout
-            if timeleft > 0:
-                raise StopIteration
-            else:
-                for _rawmsglist in self.generate_recv(sockname):
-                    if _rawmsglist[0] == _id:
-                        _res = _rawmsglist[1:]
-                        if len(_res) == 2:
-                            yield _res[0], msgpack.unpackb(_res[1])
-                        else:
-                            yield _res[0]
-                    else:
-                        self.log.warn("unknown: %s" % _rawmsglist)
+                                                            _provider))
+                    _providers.append(_provider)
+                    _now = time.time()
+                    if settle is None:
+                        # stragglers get as long as the first one took
+                        settle = max(self.rc_settle, _now - timestart)
+                    deadline = min(timestart + timeout, _now + settle)
+                    if maxp and len(_providers) >= maxp:
+                        # the outer loop stops on this too
+                        break
+        finally:
+            self.unsubscribe(_id, control=_control)
+
+        if _expected is not None:
+            _stale = _expected.difference(_providers)
+            _unlisted = set(_providers).difference(_expected)
+            if _stale:
+                self.log.info("registered but silent providers of %s: %s",
+                              signature, sorted(_stale))
+            if _unlisted:
+                self.log.info("unregistered providers of %s: %s",
+                              signature, sorted(_unlisted))
+        if not _providers:
+            raise NameError("no providers of %s" % signature)
+        self._rc_cache[signature] = (time.time(), tuple(_providers))
+        return _providers
+
+    def get_providers_all(self, signature, rollcall=False, **kwargs):
+        "get RPC handlers, by rollcall if asked or zookeeper is unwell"
+        if not rollcall and self.zk.state == KazooState.CONNECTED:
+            try:
+                return [provider for provider in self.get_providers(signature)]
+            except KazooException as e:
+                self.log.warn("zookeeper lookup of %s failed: %s",
+                              signature, e)
+        return self.get_providers_rc(signature, **kwargs)
+
+    def call_timeout(self, method, providers=None):
+        "deadline for a call from what providers have taken lately"
+        _timeout = self.latency.timeout(method, providers)
+        if _timeout is None:
+            return self.timeout
+        return _timeout
+
+    def missed(self, method, provider):
+        _misses = self.latency.missed(method, provider)
+        if _misses == self.latency.miss_limit:
+            self.log.info("%s has missed %d deadlines for %s in a row",
+                          provider, _misses, method)
+
+    def without_slow(self, method, providers):
+        "providers, less the outliers, unless that leaves nobody"
+        _slow = self.latency.outliers(method, providers)
+        _rest = [_provider for _provider in providers
+                 if _provider not in _slow]
+        if _slow and _rest:
+            self.log.debug("leaving out slow providers of %s: %s",
+                           method, sorted(_slow))
+            return _rest
+        return providers
+
+    def _was_shed(self, rawmsglist, meta):
+        if meta and meta.get('shed'):
+            self.log.debug("SHED: <FROM:%s>", rawmsglist[1])
+            self.counters['shed'] += 1
+            return True
+        return False
+
+    def request_response(self, method, args, timeout=None, sockname=None,
+                         priority=False, window=None, raw=False):
+        "responses to an RPC-like call, from whoever answers"
+        timeout = timeout or self.call_timeout(method)
+        return zSwarmCall(self, method, args, timeout=timeout,
+                          sockname=sockname, control=priority,
+                          window=window, raw=raw)
 
     def request_response_certain(self, signature, args, providers=None,
-                                 only=False, timeout=None, sockname=None):
-        "generate responses from an optional provider list for an RPC"
-        sockname = sockname or self.in_sock_type
-        timeout = timeout or self.timeout
-        providers = providers or self.get_providers_all(signature,
-                                                        timeout=timeout,
-                                                        sockname=sockname)
-        remaining = set(providers)
-        _mpargs = msgpack.packb(args)
-        self.log.debug("MPARGS: '%s' -> '%s'" % (args, _mpargs))
-        _id, _subscribe, _send = self.publish_replyable(_mpargs,
-                                                        topic=signature)
-        timestart = time.time()
-        while True:
-            timeleft = time.time() - timestart - timeout
-            if not remaining:
-                self.log.debug("Everybody responded, nice")
-                self.unsubscribe(_id)
-                raise StopIteration
-            elif timeleft > 0:
-                self.log.debug("no timeleft")
-                self.unsubscribe(_id)
-                raise StopIteration
-            else:
-                for _rawmsglist in self.generate_recv(sockname, arity=3):
-                    if _rawmsglist[0] == _id:
-                        _rtopic, _provider, _message = _rawmsglist
-                        if _provider in remaining:
-                            self.log.debug("REG: <FROM:%s>%s" % (_provider,
-                                                                 _message))
-                            remaining.remove(_provider)
-                        elif _provider in providers:
-                            self.log.debug("MULTI: <FROM:%s>%s" % (_provider,
-                                                                   _message))
-                            if only:
-                                continue
-                        else:
-                            self.log.debug("UNREG: <FROM:%s>%s" % (_provider,
-                                                                   _message))
-                            if only:
-                                continue
-
-                        _res = _rawmsglist[1:]
-                        if len(_res) == 2:
-                            yield _res[0], msgpack.unpackb(_res[1])
-                        else:
-                            yield _res[0]
-
-                        if not remaining:
-                            self.log.debug("Everybody responded, nice")
-                            self.unsubscribe(_id)
-                            raise StopIteration
-                    else:
-                        self.log.warn("unknown: %s" % _rawmsglist)
-        self.unsubscribe(_id)
+                                 only=False, timeout=None, sockname=None,
+                                 rollcall=False, priority=False,
+                                 window=None, raw=False, exclude_slow=False):
+        "responses from an optional provider list for an RPC"
+        if not providers:
+            providers = self.get_providers_all(signature, rollcall=rollcall,
+                                               timeout=timeout)
+            if exclude_slow:
+                providers = self.without_slow(signature, providers)
+        timeout = timeout or self.call_timeout(signature, providers)
+        return zSwarmCall(self, signature, args, providers=providers,
+                          only=only, timeout=timeout, sockname=sockname,
+                          control=priority, window=window, raw=raw)
 
     def request_response_certain_all(self, signature, args, providers=None,
                                      only=False, timeout=None,
-                                     sockname=None):
+                                     sockname=None, rollcall=False,
+                                     priority=False, window=None,
+                                     raw=False, exclude_slow=False):
         "return responses from an optional provider list for an RPC"
-        sockname = sockname or self.in_sock_type
-        timeout = timeout or self.timeout
-        providers = providers or list(
-            self.get_providers(signature, timeout=timeout, sockname=sockname))
-        remaining = set(providers)
+        if not providers:
+            providers = self.get_providers_all(signature, rollcall=rollcall,
+                                               timeout=timeout)
+            if exclude_slow:
+                providers = self.without_slow(signature, providers)
+        timeout = timeout or self.call_timeout(signature, providers)
         resp = dict([(provider, None) for provider in providers])
-        _mpargs = msgpack.packb(args)
-        self.log.debug("MPARGS: '%s' -> '%s'" % (args, _mpargs))
-        _id, _subscribe, _send = self.publish_replyable(_mpargs, signature)
-        timestart = time.time()
-        while True:
-            timeleft = time.time() - timestart - timeout
-            if not remaining:
-                self.log.debug("Everybody responded, nice")
-                self.unsubscribe(_id)
-                return resp.items()
-            elif timeleft > 0:
-                self.log.debug("no timeleft")
-                self.unsubscribe(_id)
-                return resp.items()
-            else:
-                for _rawmsglist in self.generate_recv(sockname, arity=3):
-                    if _rawmsglist[0] == _id:
-                        _rtopic, _provider, _message = _rawmsglist
-                        if _provider in remaining:
-                            self.log.debug("Registered response: "
-                                           "<FROM:%s>%s" % (_provider, _message))
-                            remaining.remove(_provider)
-                            resp[_provider] = msgpack.unpackb(_message)
-                        elif _provider in providers:
-                            self.log.debug("Multiple response?: "
-                                           "<FROM:%s>%s" % (_provider, _message))
-                            if only:
-                                continue
-                            else:
-                                resp[_provider] = msgpack.unpackb(_message)
-                        else:
-                            self.log.debug("Unexpected response: "
-                                           "<FROM:%s>%s" % (_provider, _message))
-                            if only:
-                                continue
-                            else:
-                                resp[_provider] = msgpack.unpackb(_message)
-                        if not remaining:
-                            self.log.debug("Everybody responded, nice")
-                            self.unsubscribe(_id)
-                            return resp.items()
-                    else:
-                        self.log.warn("unknown: %s" % _rawmsglist)
\ No newline at end of file
+        with zSwarmCall(self, signature, args, providers=providers,
+                        only=only, timeout=timeout, sockname=sockname,
+                        control=priority, window=window,
+                        raw=raw) as _call:
+            for _provider, _result in _call:
+                resp[_provider] = _result
+        return resp.items()
@@ -17,9 +17,12 @@
 import uuid
 import zmq
 import msgpack
+import struct
+import collections
 
 from . import log, logging
 from .zkazoo import KazooContext
+from .zwire import TERMINATOR, new_id, encode_envelope, decode_envelope
 from time import sleep
 
 
@@ -30,9 +33,16 @@ class zSwarmPrimitive(object):
     uniqueaddr = lambda self: "%s=%s" % (self.swarmtype, self.id)
     in_sock_type = 'XSUB'
     out_sock_type = 'XPUB'
-    
+    # drops from one sender within a stream before we complain
+    behind_threshold = 1
+    # gets a copy of every message sent or received, see zrecord
+    recorder = None
+
     def __init__(self, identity=None, name=None,
-                 zmq_context=None, kazoo_context=None, timeout=0.250):
+                 zmq_context=None, kazoo_context=None, timeout=0.250,
+                 sndhwm=None, rcvhwm=None, linger=None,
+                 sndbuf=None, rcvbuf=None, sequenced=True,
+                 control_lane=False):
         self.id = identity or str(uuid.uuid4())
         self.name = name or self.__class__.__name__
         self.log = logging.getLogger("%s.%s" % (log.name, self.name))
@@ -45,6 +55,26 @@ class zSwarmPrimitive(object):
 
         self.timeout = timeout
 
+        # None leaves the zmq default alone
+        self.sockopts = dict()
+        for _opt, _val in (('SNDHWM', sndhwm), ('RCVHWM', rcvhwm),
+                           ('LINGER', linger), ('SNDBUF', sndbuf),
+                           ('RCVBUF', rcvbuf)):
+            if _val is not None:
+                self.sockopts[getattr(zmq, _opt)] = _val
+
+        # per-(lane, topic) sequence numbers stamped on what we publish,
+        # and the last one seen per (sender, lane, topic) stream on what
+        # we receive; the lanes overtake each other, so each counts alone
+        self.sequenced = sequenced
+        self._seq = dict()
+        self._seen = dict()
+        self.counters = collections.Counter()
+        # sender -> frames lost from its streams
+        self.drops = collections.Counter()
+        # alias -> messages read early by catch_up, still to be handed out
+        self._held = collections.defaultdict(collections.deque)
+
         # in-band poller
         self._poller = zmq.Poller()
 
@@ -57,6 +87,7 @@ class zSwarmPrimitive(object):
         self._out_socket = self._zmqcontext.socket(getattr(zmq, self.out_sock_type))
         if self.out_sock_type == 'XPUB':
             self._out_socket.setsockopt(zmq.XPUB_VERBOSE, 1)
+        self.setsockopts(self._out_socket)
 
         self._out_socket.setsockopt(zmq.IDENTITY,
                                     "%s.%s" % (self.id, self.out_sock_type))
@@ -68,6 +99,7 @@ class zSwarmPrimitive(object):
             self._oob_poller.register(self._out_socket, zmq.POLLIN)        
 
         self._in_socket = self._zmqcontext.socket(getattr(zmq, self.in_sock_type))
+        self.setsockopts(self._in_socket)
         self._in_socket.setsockopt(zmq.IDENTITY,
                                    "%s.%s" % (self.id, self.in_sock_type))
         self._aliases[self._in_socket] = self.in_sock_type
@@ -77,46 +109,94 @@ class zSwarmPrimitive(object):
         if self.in_sock_type == 'XSUB':
             self._oob_poller.register(self._in_socket, zmq.POLLOUT)            
 
-        self.uniquesub()
+        # optional second pair, so control traffic and small urgent calls
+        # don't queue up behind bulk payloads
+        self.ctl_in_sock_type = 'CTL_%s' % self.in_sock_type
+        self.ctl_out_sock_type = 'CTL_%s' % self.out_sock_type
+        self._ctl_in_socket, self._ctl_out_socket = None, None
+        if control_lane:
+            self._ctl_out_socket = self._lane_socket(self.out_sock_type,
+                                                     self.ctl_out_sock_type)
+            self._poller.register(self._ctl_out_socket, zmq.POLLOUT)
+            self._ctl_in_socket = self._lane_socket(self.in_sock_type,
+                                                    self.ctl_in_sock_type)
+            self._poller.register(self._ctl_in_socket, zmq.POLLIN)
+        self._in_sockets = [_s for _s in (self._ctl_in_socket,
+                                          self._in_socket) if _s]
+        self._out_sockets = [_s for _s in (self._ctl_out_socket,
+                                           self._out_socket) if _s]
 
+        self.uniquesub()
 
-    def bind(self, inep, outep):
+    def _lane_socket(self, socktype, alias):
+        _sock = self._zmqcontext.socket(getattr(zmq, socktype))
+        if socktype == 'XPUB':
+            _sock.setsockopt(zmq.XPUB_VERBOSE, 1)
+        self.setsockopts(_sock)
+        _sock.setsockopt(zmq.IDENTITY, "%s.%s" % (self.id, alias))
+        self._aliases[_sock] = alias
+        self._aliases[alias] = _sock
+        return _sock
+
+    @property
+    def control_lane(self):
+        return self._ctl_in_socket is not None
+
+    def lane(self, control=False):
+        "(in socket, out socket) to use, control lane if asked and present"
+        if control and self.control_lane:
+            return self._ctl_in_socket, self._ctl_out_socket
+        return self._in_socket, self._out_socket
+
+    def lane_alias(self, control=False):
+        "alias of the in socket replies for a lane come back on"
+        return self._aliases[self.lane(control)[0]]
+
+    def setsockopts(self, sock):
+        "apply the configured buffering options to a socket"
+        for _opt, _val in self.sockopts.items():
+            sock.setsockopt(_opt, _val)
+
+    def bind(self, inep, outep, control=False):
+        _in, _out = self.lane(control)
         _o_b, _i_b = None, None
         try:
-            _o_b = self._out_socket.bind(outep) or True
-            _i_b = self._in_socket.bind(inep) or True
+            _o_b = _out.bind(outep) or True
+            _i_b = _in.bind(inep) or True
         except zmq.error.ZMQError:
             if _o_b:
-              self._out_socket.unbind(outep)
+              _out.unbind(outep)
             if _i_b:
-              self._in_socket.unbind(inep)
+              _in.unbind(inep)
             return False
         else:
             return True
 
-    def connect(self, inep, outep):
+    def connect(self, inep, outep, control=False):
+        _in, _out = self.lane(control)
         _o_b, _i_b = None, None
         try:
-            _o_b = self._out_socket.connect(outep) or True
-            _i_b = self._in_socket.connect(inep) or True
+            _o_b = _out.connect(outep) or True
+            _i_b = _in.connect(inep) or True
         except zmq.error.ZMQError:
             if _o_b:
-                self._out_socket.disconnect(outep)
+                _out.disconnect(outep)
             if _i_b:
-                self._in_socket.disconnect(inep)
+                _in.disconnect(inep)
             return False
         else:
             return True
 
-    def disconnect(self, inep, outep):
+    def disconnect(self, inep, outep, control=False):
+        _in, _out = self.lane(control)
         _ret = True
         try:
-            self._out_socket.disconnect(outep)
+            _out.disconnect(outep)
         except zmq.error.ZMQError:
             # maybe you weren't already connected???
             _ret = False
         try:
-            self._in_socket.disconnect(inep)
+            _in.disconnect(inep)
         except zmq.error.ZMQError:
             # maybe you weren't already connected???
             _ret = False
@@ -206,8 +286,10 @@ class zSwarmPrimitive(object):
                     else:
                         _msg = _rawmsg
                 elif sockalias in ('SUB', 'XSUB'):
-                    _rawmsglist = self._aliases[sockalias].recv_multipart()
-                    if len(_rawmsglist) == 3:
+                    _rawmsglist, _meta = self.recv_frames(sockalias)
+                    if _rawmsglist is None:
+                        _msg = "<MALFORMED>"
+                    elif len(_rawmsglist) == 3:
                         # oh, replyable
                         _topic, _replyto, _rawmsg = _rawmsglist
                         _msg = "<TOPIC:%s><REPLY-TO:%s>%s" % (
@@ -232,115 +314,247 @@ class zSwarmPrimitive(object):
             else:
                 sleep(0.250)
 
-    def subscribe(self, topic=''):
+    def subscribe(self, topic='', control=None, prefix=False):
         "subscribe to topic"
-        if self._aliases[self._in_socket] == 'SUB':
-            return self._in_socket.setsockopt(zmq.SUBSCRIBE, topic)
-        elif self._aliases[self._in_socket] == 'XSUB':
-            return self._in_socket.send("\x01" + topic)
+        return self.subscribe_many([topic], control, prefix)
 
-    def unsubscribe(self, topic=''):
+    def unsubscribe(self, topic='', control=None, prefix=False):
         "unsubscribe from a topic"
-        if self._aliases[self._in_socket] == 'SUB':
-            return self._in_socket.setsockopt(zmq.UNSUBSCRIBE, topic)
-        elif self._aliases[self._in_socket] == 'XSUB':
-            return self._in_socket.send("\x00" + topic)
-
-    def publish_withid(self, message=None, topic='', addr=None):
+        return self.unsubscribe_many([topic], control, prefix)
+
+    def _lane_in_sockets(self, control=None):
+        # None is every lane
+        if control is None:
+            return self._in_sockets
+        return [self.lane(control)[0]]
+
+    def drain_subscriptions(self):
+        "throw away subscription notices queued up on XPUB"
+        # left unread, they back up until the subscriber end starts
+        # dropping new subscriptions, reply addresses included
+        _n = 0
+        if self.out_sock_type == 'XPUB':
+            for _sock in self._out_sockets:
+                while _sock.poll(0, zmq.POLLIN):
+                    _sock.recv_multipart()
+                    _n += 1
+        self.counters['subscriptions'] += _n
+        return _n
+
+    def subscribe_many(self, topics, control=None, prefix=False):
+        "subscribe to several topics, frames sent back to back"
+        if not prefix:
+            # whole topics only: cats shouldn't hear about catsfoo
+            topics = [topic + TERMINATOR for topic in topics]
+        for _sock in self._lane_in_sockets(control):
+            if self.in_sock_type == 'SUB':
+                for topic in topics:
+                    _sock.setsockopt(zmq.SUBSCRIBE, topic)
+            elif self.in_sock_type == 'XSUB':
+                # one frame per topic is the XSUB protocol, but queued
+                # together they leave in as few writes as zmq can manage
+                for topic in topics:
+                    _sock.send("\x01" + topic)
+
+    def unsubscribe_many(self, topics, control=None, prefix=False):
+        "unsubscribe from several topics, frames sent back to back"
+        if not prefix:
+            topics = [topic + TERMINATOR for topic in topics]
+        for _sock in self._lane_in_sockets(control):
+            if self.in_sock_type == 'SUB':
+                for topic in topics:
+                    _sock.setsockopt(zmq.UNSUBSCRIBE, topic)
+            elif self.in_sock_type == 'XSUB':
+                for topic in topics:
+                    _sock.send("\x00" + topic)
+
+    def publish_withid(self, message=None, topic='', addr=None, meta=None,
+                       control=False):
         "publish a message with a reply address attached"
         # ephemeral reply point
         addr = addr or self.uniqueaddr()
+        _out = self.lane(control)[1]
         if message is None:
             # don't send a message
             _payload = None
-            _parts = [topic, addr]
         elif not message:
             # send a null messsage
             _payload = ''
-            _parts = [topic, addr, _payload]
         elif type(message) in [str, bytes]:
             # already msgpacked, precooked
             _payload = message
-            _parts = [topic, addr, _payload]
         else:
             # assume it's a list and it's your problem sucka
             _payload = msgpack.packb(message)
-            _parts = [topic, addr, _payload]
 
         if _payload is not None:
             self.log.debug(
                 "%s.publish.%s: ->"
-                " <TOPIC:%s>"
-                "<REPLY-FROM:%s>%s" % (self.name,
-                                       self._aliases[self._out_socket],
-                                       topic, addr, _payload))
+                " <TOPIC:%r>"
+                "<REPLY-FROM:%s><%d bytes>", self.name, self._aliases[_out],
+                topic, addr, len(_payload))
         else:
             self.log.debug(
                 "%s.publish.%s: ->"
-                " <TOPIC:%s>"
-                "<REPLY-FROM:%s><NULL>" % (self.name,
-                                           self._aliases[self._out_socket],
-                                           topic, addr))
-        _send = self._out_socket.send_multipart(_parts)
+                " <TOPIC:%r>"
+                "<REPLY-FROM:%s><NULL>", self.name, self._aliases[_out],
+                topic, addr)
+        _parts = encode_envelope(topic, addr, _payload, meta)
+        if self.recorder is not None:
+            self.recorder.record('out', control, _parts)
+
+        # have XPUB take in pending subscriptions first, or a reply to a
+        # freshly subscribed address can be dropped on the floor
+        _out.getsockopt(zmq.EVENTS)
+        _send = _out.send_multipart(_parts)
         return _send
 
-    def publish_replyable(self, message=None, topic='', addr=None):
+    def publish_replyable(self, message=None, topic='', addr=None,
+                          deadline=None, control=False, meta=None):
         "publish a message with a unique generated reply address"
         # ephemeral reply point
-        addr = addr or str(uuid.uuid4())
+        addr = addr or new_id()
+        _out = self.lane(control)[1]
         if message is None:
             # don't send a message
             _payload = None
-            _parts = [topic, addr]
         elif not message:
             # send a null messsage
             _payload = ''
-            _parts = [topic, addr, _payload]
         elif type(message) in [str, bytes]:
             # already msgpacked, precooked
             _payload = message
-            _parts = [topic, addr, _payload]
         else:
             # assume it's a list and it's your problem sucka
             _payload = msgpack.packb(message)
-            _parts = [topic, addr, _payload]
 
         if _payload is not None:
             self.log.debug(
                 "%s.publish.%s: ->"
                 " <TOPIC:%s>"
-                "<REPLY-TO:%s>%s" % (self.name,
-                                     self._aliases[self._out_socket],
-                                     topic, addr, _payload))
+                "<REPLY-TO:%r><%d bytes>", self.name, self._aliases[_out],
+                topic, addr, len(_payload))
         else:
             self.log.debug(
                 "%s.publish.%s: ->"
                 " <TOPIC:%s>"
-                "<REPLY-TO:%s><NULL>" % (self.name,
-                                         self._aliases[self._out_socket],
-                                         topic, addr))
-
-        _subscribe = self.subscribe(addr)
-        _send = self._out_socket.send_multipart(_parts)
+                "<REPLY-TO:%r><NULL>", self.name, self._aliases[_out],
+                topic, addr)
+
+        _meta = dict()
+        if self.sequenced:
+            _control = _out is self._ctl_out_socket
+            _n = self._seq.get((_control, topic), 0) + 1
+            self._seq[(_control, topic)] = _n
+            _meta.update(s=self.uniqueaddr(), n=_n)
+            if _control:
+                # relays can merge the lanes, so say which one it was
+                _meta['ctl'] = True
+        if deadline is not None:
+            # absolute time.time(), so clocks had better agree
+            _meta['d'] = deadline
+        if meta:
+            _meta.update(meta)
+        _parts = encode_envelope(topic, addr, _payload, _meta)
+        if self.recorder is not None:
+            self.recorder.record('out', control, _parts)
+
+        # replies come back on the lane the request went out on
+        _subscribe = self.subscribe(addr, control=control)
+        _send = _out.send_multipart(_parts)
         return addr, _subscribe, _send
 
     # TODO: make this smarter - recieve messages to a topic-based queue
     # and allow for polling on specific topic only
-    def generate_recv(self, sockname=None, arity=None, timeout=None):
+    def generate_recv(self, sockname=None, arity=None, timeout=None,
+                      meta=False):
         timeout = timeout or self.timeout
         sockname = sockname or self.in_sock_type
-        _ps = self.pollsocks()
+        _held = self._held[sockname]
         while True:
-            if sockname in _ps and _ps[sockname] & zmq.POLLIN:
-                _inc = self._aliases[sockname].recv_multipart()
-                if not arity or len(_inc) == arity:
-                    yield _inc
-                else:
-                    self.log.warn("discarding %s" % _inc)
+            if _held:
+                _inc, _meta = _held.popleft()
             else:
-                break
+                # re-poll each time, a stale result would block in recv
+                _ps = self.pollsocks()
+                if not (sockname in _ps and _ps[sockname] & zmq.POLLIN):
+                    break
+                _inc, _meta = self.recv_frames(sockname)
+                if _inc is None or self.intercept(_inc, _meta):
+                    continue
+            if not arity or len(_inc) == arity:
+                yield (_inc, _meta) if meta else _inc
+            else:
+                self.log.warn("discarding %s" % _inc)
         raise StopIteration
 
+    def intercept(self, frames, meta):
+        "take a message off the receive path before callers see it"
+        return False
+
+    def catch_up(self):
+        "read everything waiting now, holding on to what isn't intercepted"
+        for _sock in self._in_sockets:
+            _alias = self._aliases[_sock]
+            while _sock.poll(0, zmq.POLLIN):
+                _frames, _meta = self.recv_frames(_alias)
+                if _frames is not None and \
+                        not self.intercept(_frames, _meta):
+                    self._held[_alias].append((_frames, _meta))
+
+    def recv_frames(self, sockname=None):
+        "receive a message, returning its frames and metadata"
+        sockname = sockname or self.in_sock_type
+        _raw = self._aliases[sockname].recv_multipart()
+        self.counters['received'] += 1
+        if self.recorder is not None:
+            self.recorder.record('in', sockname == self.ctl_in_sock_type,
+                                 _raw)
+        try:
+            _frames, _meta = decode_envelope(_raw)
+        except (ValueError, KeyError, struct.error) as e:
+            # (None, None), so nobody mistakes it for a request
+            self.counters['malformed'] += 1
+            self.log.warn("malformed message: %s", e)
+            return None, None
+        if _meta and 'n' in _meta:
+            self._sequence(_frames[0], _meta['s'], _meta['n'],
+                           _meta.get('ctl', False))
+        return _frames, _meta
+
+    def _sequence(self, topic, sender, n, control=False):
+        _stream = (sender, control, topic)
+        _last = self._seen.get(_stream)
+        if _last is None or n > _last:
+            self._seen[_stream] = n
+        if _last is None:
+            return
+        if n > _last + 1:
+            _lost = n - _last - 1
+            self.counters['dropped'] += _lost
+            self.drops[sender] += _lost
+            if _lost >= self.behind_threshold:
+                self.falling_behind(sender, topic, _lost)
+        elif n <= _last:
+            self.counters['late'] += 1
+
+    def falling_behind(self, sender, topic, lost):
+        "called when frames from sender on topic went missing"
+        self.log.warn("lost %d frames of %s from %s (%d total), "
+                      "not keeping up?", lost, topic, sender,
+                      self.drops[sender])
+
+    def stray(self, rawmsglist):
+        "note a message that arrived for nobody, usually a late reply"
+        self.counters['stray'] += 1
+        self.log.warn("unknown: %s" % rawmsglist)
+
     def uniquesub(self):
         "subscribe to my unique address"
         return self.subscribe(self.uniqueaddr())
+
+    def close(self):
+        "close every socket, from the thread that uses them"
+        for _sock in self._aliases.keys():
+            if isinstance(_sock, zmq.Socket):
+                _sock.close(linger=0)
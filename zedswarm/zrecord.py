@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2013 Dave Carlson <thecubic@thecubic.net>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import zmq
+import time
+import uuid
+import struct
+import logging
+import threading
+import collections
+import msgpack
+from .zwire import decode_envelope
+from .zkazoo import LocalKazoo
+from .zmaster import zSwarmMaster
+from .zdrone import zSwarmDrone
+
+RECORD_MAGIC = 'ZSWREC1\n'
+# time, direction, lane, frame count; then each frame length-prefixed
+RECORD = struct.Struct('!dBBH')
+FRAMELEN = struct.Struct('!I')
+DIRECTIONS = {'out': 0, 'in': 1}
+_DIRECTION_NAMES = dict((_v, _k) for _k, _v in DIRECTIONS.items())
+
+
+class zSwarmRecorder(object):
+    "append-only log of the frames a master or drone sends and receives"
+    records = 0
+
+    def __init__(self, path, buffering=1 << 16):
+        self.path = path
+        self._file = open(path, 'ab', buffering)
+        if self._file.tell() == 0:
+            self._file.write(RECORD_MAGIC)
+        # sniffer threads and callers can share one primitive
+        self._lock = threading.Lock()
+
+    def attach(self, primitive):
+        "start recording everything primitive sends and receives"
+        primitive.recorder = self
+        return self
+
+    def detach(self, primitive):
+        if primitive.recorder is self:
+            primitive.recorder = None
+
+    def record(self, direction, control, frames):
+        _parts = [RECORD.pack(time.time(), DIRECTIONS[direction],
+                              1 if control else 0, len(frames))]
+        for _frame in frames:
+            _parts.append(FRAMELEN.pack(len(_frame)))
+            _parts.append(_frame)
+        with self._lock:
+            self._file.write(''.join(_parts))
+            self.records += 1
+
+    def flush(self):
+        with self._lock:
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def read_recording(path):
+    "(time, direction, control, frames) for every record in a log"
+    with open(path, 'rb') as _file:
+        if _file.read(len(RECORD_MAGIC)) != RECORD_MAGIC:
+            raise ValueError("%s is not a zedswarm recording" % path)
+        while True:
+            _head = _file.read(RECORD.size)
+            if len(_head) < RECORD.size:
+                # a torn last record is what a crash leaves behind
+                return
+            _when, _direction, _lane, _count = RECORD.unpack(_head)
+            _frames = []
+            for _n in xrange(_count):
+                _len = _file.read(FRAMELEN.size)
+                if len(_len) < FRAMELEN.size:
+                    return
+                (_len,) = FRAMELEN.unpack(_len)
+                _frame = _file.read(_len)
+                if len(_frame) < _len:
+                    return
+                _frames.append(_frame)
+            yield _when, _DIRECTION_NAMES[_direction], bool(_lane), _frames
+
+
+class zSwarmReplayer(object):
+    "drives a master with the calls a recorded master made"
+    # remember: {} is a static attribute
+    # which is not what you want
+    stats = None
+    latencies = None
+
+    def __init__(self, master, path, speed=1.0, methods=None):
+        self.master = master
+        self.path = path
+        # 2.0 replays twice as fast, None as fast as replies allow
+        self.speed = speed
+        # only replay these methods, if given
+        self.methods = methods
+        self.log = logging.getLogger("%s.replay" % master.log.name)
+        self.stats = collections.Counter()
+        # method -> seconds to first reply, per call
+        self.latencies = collections.defaultdict(list)
+        # recorded reply id -> ours
+        self._ids = dict()
+        # our reply id -> [method, sent, deadline, control, answered]
+        self._pending = dict()
+        self._poller = zmq.Poller()
+        for _sock in master._in_sockets:
+            self._poller.register(_sock, zmq.POLLIN)
+
+    def calls(self):
+        "(time, control, method, reply id, payload, metadata) recorded"
+        for _when, _direction, _control, _raw in read_recording(self.path):
+            if _direction != 'out' or len(_raw) != 3:
+                # replies, credit grants, heartbeats
+                continue
+            try:
+                _frames, _meta = decode_envelope(_raw)
+            except (ValueError, KeyError, struct.error):
+                self.stats['malformed'] += 1
+                continue
+            _topic, _id, _payload = _frames
+            if self.methods is None or _topic in self.methods or \
+                    _topic == '_cancel':
+                yield _when, _control, _topic, _id, _payload, _meta
+
+    def run(self, linger=None):
+        "replay the whole recording, returning the stats"
+        linger = self.master.timeout if linger is None else linger
+        _started = time.time()
+        _first = None
+        for _when, _control, _topic, _id, _payload, _meta in self.calls():
+            if _first is None:
+                _first = _when
+            if self.speed:
+                self.collect(_started + (_when - _first) / self.speed)
+            else:
+                self.collect(time.time())
+            if _topic == '_cancel':
+                self._cancel(msgpack.unpackb(_payload))
+            else:
+                self._call(_when, _control, _topic, _id, _payload, _meta)
+        # stragglers
+        _until = time.time() + linger
+        while self._pending and time.time() < _until:
+            self.collect(min(_until, time.time() + self.master.timeout))
+        for _id in list(self._pending):
+            self._expire(_id)
+        self.stats['elapsed'] = time.time() - _started
+        return self.stats
+
+    def _call(self, when, control, method, recorded_id, payload, meta):
+        _budget = self.master.timeout
+        if meta and 'd' in meta:
+            # the same time to answer as the original call had
+            _budget = max(0, meta['d'] - when)
+        _now = time.time()
+        # no window: we don't grant credit, so large replies come whole
+        _id, _subscribe, _send = self.master.publish_replyable(
+            payload, topic=method, deadline=_now + _budget, control=control)
+        self._ids[recorded_id] = _id
+        self._pending[_id] = [method, _now, _now + _budget, control, False]
+        self.stats['sent'] += 1
+
+    def _cancel(self, recorded_ids):
+        _ids = [self._ids[_id] for _id in recorded_ids if _id in self._ids]
+        if _ids:
+            self.master.publish_withid(msgpack.packb(_ids), topic='_cancel',
+                                       control=True)
+            for _id in _ids:
+                if _id in self._pending:
+                    self._expire(_id)
+            self.stats['cancelled'] += len(_ids)
+
+    def _expire(self, replyid):
+        _method, _sent, _deadline, _control, _answered = \
+            self._pending.pop(replyid)
+        if not _answered:
+            self.stats['unanswered'] += 1
+        self.master.unsubscribe(replyid, control=_control)
+
+    def collect(self, until):
+        "take replies in until then, and whatever is already waiting"
+        while True:
+            _now = time.time()
+            for _id, _call in self._pending.items():
+                if _call[2] < _now:
+                    self._expire(_id)
+            _ready = self._poller.poll(max(0, until - _now) * 1000)
+            for _sock, _ev in _ready:
+                _frames, _meta = self.master.recv_frames(
+                    self.master._aliases[_sock])
+                if _frames is None or self.master.intercept(_frames, _meta):
+                    continue
+                self._reply(_frames, _meta)
+            if not _ready and time.time() >= until:
+                return
+
+    def _reply(self, frames, meta):
+        _call = self._pending.get(frames[0])
+        if _call is None:
+            self.master.stray(frames)
+            return
+        if meta and meta.get('shed'):
+            self.stats['shed'] += 1
+            return
+        self.stats['replies'] += 1
+        if not _call[4]:
+            _call[4] = True
+            self.stats['answered'] += 1
+            self.latencies[_call[0]].append(time.time() - _call[1])
+
+    def summary(self):
+        "method -> (calls answered, median, 99th percentile seconds)"
+        _summary = dict()
+        for _method, _latencies in self.latencies.iteritems():
+            _sorted = sorted(_latencies)
+            _summary[_method] = (len(_sorted), _sorted[len(_sorted) // 2],
+                                 _sorted[min(len(_sorted) - 1,
+                                             int(0.99 * len(_sorted)))])
+        return _summary
+
+
+def local_swarm(handlers, drones=2, transport='inproc', kazoo_context=None,
+                **kwargs):
+    "a master and drones serving {method: func} in this process"
+    # LocalKazoo unless you want to see it in a real zookeeper
+    kazoo_context = kazoo_context or LocalKazoo()
+    _base = "%s://%szedswarm.%s" % (transport,
+                                    '/tmp/' if transport == 'ipc' else '',
+                                    uuid.uuid4())
+    _vector = ["%s.in" % _base, "%s.in" % _base,
+               "%s.out" % _base, "%s.out" % _base]
+    _master = zSwarmMaster(name="replay-master", bind_vector=_vector,
+                           kazoo_context=kazoo_context, **kwargs)
+    _drones = []
+    for _n in xrange(drones):
+        _drone = zSwarmDrone(name="replay-drone-%d" % _n,
+                             kazoo_context=kazoo_context)
+        _drone.register_many(handlers)
+        _t = threading.Thread(target=_drone.blocking_sniffer,
+                              name="%s.blocking_sniffer" % _drone.name)
+        _t.daemon = True
+        _t.start()
+        _drones.append(_drone)
+    return _master, _drones
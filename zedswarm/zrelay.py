@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2013 Dave Carlson <thecubic@thecubic.net>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import zmq
+import msgpack
+from .zdrone import zSwarmFollower
+
+
+class zSwarmRelay(zSwarmFollower):
+    """stands in for every master to the drones connected to it
+
+    requests come down from the masters and go out to our drones;
+    replies and heartbeats go back up, and so do the drones'
+    subscriptions, so masters only ever fan out to relays
+    """
+    swarmtype = "relay"
+    locality = None
+    _down_in_socket = None
+    _down_out_socket = None
+    _down_ctl_in_socket = None
+    _down_ctl_out_socket = None
+
+    def __init__(self, bind_vector=None, control_vector=None, locality=None,
+                 *args, **kwargs):
+        # upstream, we look like a drone to the masters
+        kwargs.setdefault('control_lane', True)
+        super(zSwarmRelay, self).__init__(*args, **kwargs)
+        # drones with the same locality prefer us
+        self.locality = locality
+        self._down_out_socket = self._lane_socket(self.out_sock_type,
+                                                  'DOWN_%s' % self.out_sock_type)
+        self._down_in_socket = self._lane_socket(self.in_sock_type,
+                                                 'DOWN_%s' % self.in_sock_type)
+        if control_vector:
+            self._down_ctl_out_socket = self._lane_socket(
+                self.out_sock_type, 'DOWN_%s' % self.ctl_out_sock_type)
+            self._down_ctl_in_socket = self._lane_socket(
+                self.in_sock_type, 'DOWN_%s' % self.ctl_in_sock_type)
+        _adds, _fails, _deletes, _existing = self.refresh()
+        self.log.info("relaying for %d masters", _adds)
+        if bind_vector:
+            self.bind(*bind_vector, control_vector=control_vector)
+
+    def bind(self, pub_inep, priv_inep, pub_outep, priv_outep,
+             control_vector=None):
+        "bind where drones connect and advertise it under /relays"
+        self.zk.ensure_path('/%ss' % self.swarmtype)
+        _zep_me = "/%ss/%s" % (self.swarmtype, self.uniqueaddr())
+        _bo = self._down_out_socket.bind(priv_outep)
+        _bi = self._down_in_socket.bind(priv_inep)
+        # same layout as a master's, plus where we are
+        _value = (pub_inep, pub_outep, None, None, self.locality)
+        if control_vector and self._down_ctl_out_socket is not None:
+            _cpub_inep, _cpriv_inep, _cpub_outep, _cpriv_outep = control_vector
+            self._down_ctl_out_socket.bind(_cpriv_outep)
+            self._down_ctl_in_socket.bind(_cpriv_inep)
+            _value = (pub_inep, pub_outep, _cpub_inep, _cpub_outep,
+                      self.locality)
+        _zk = self.zk.create(_zep_me, value=msgpack.packb(_value),
+                             ephemeral=True)
+        return _bo, _bi, _zk
+
+    def routes(self):
+        "socket -> sockets its messages get passed on to"
+        _routes = {
+            # requests down, drones' subscriptions up
+            self._in_socket: [self._down_out_socket],
+            self._down_out_socket: [self._in_socket],
+            # masters' reply subscriptions down; replies going up are
+            # routed per message in proxy()
+            self._out_socket: [self._down_in_socket]}
+        if self.control_lane:
+            if self._down_ctl_out_socket is None:
+                # one lane down serves both lanes up
+                _routes[self._ctl_in_socket] = [self._down_out_socket]
+                _routes[self._down_out_socket].append(self._ctl_in_socket)
+                _routes[self._ctl_out_socket] = [self._down_in_socket]
+            else:
+                _routes[self._ctl_in_socket] = [self._down_ctl_out_socket]
+                _routes[self._down_ctl_out_socket] = [self._ctl_in_socket]
+                _routes[self._ctl_out_socket] = [self._down_ctl_in_socket]
+                _routes[self._down_ctl_in_socket] = [self._ctl_out_socket]
+                # drones use our control lane whatever the masters have,
+                # so it has to hear what masters subscribe to on bulk
+                _routes[self._out_socket].append(self._down_ctl_in_socket)
+        return _routes
+
+    def bulk_only_upstream(self):
+        "whether some master we relay for has no control lane"
+        return not all(_eps[2] for _eps in self.master_book.values())
+
+    def proxy(self):
+        "pass messages and subscriptions along, until stopped"
+        self.log.debug("%s.proxy: ALIVE" % self.name)
+        _routes = self.routes()
+        _merged = self.control_lane and self._down_ctl_out_socket is None
+        # with the lanes merged below us, the reply ids masters wait on
+        # in their control lane, so replies go back up the right one
+        _ctl_topics = set()
+        _poller = zmq.Poller()
+        for _sock in _routes.keys() + [self._down_in_socket]:
+            _poller.register(_sock, zmq.POLLIN)
+        _poller.register(self.wakeup_fd(), zmq.POLLIN)
+        # subscriptions have to be through before the requests whose
+        # replies they're for, or the drone's XPUB drops the reply
+        _subscribers = set([self._out_socket, self._ctl_out_socket,
+                            self._down_out_socket,
+                            self._down_ctl_out_socket])
+        _subscribers.discard(None)
+        while not self.stopping:
+            _ready = dict(_poller.poll())
+            # upstreams only ever change here, between messages
+            self.refresh_planned(_ready.pop(self.wakeup_fd(), None)
+                                 is not None)
+            # control traffic coming up also goes out on bulk for masters
+            # that would never see it otherwise
+            _ctl_up = _routes.get(self._down_ctl_in_socket)
+            if _ctl_up is not None and self.bulk_only_upstream():
+                _ctl_up = _ctl_up + [self._out_socket]
+            _order = sorted(_ready, key=lambda _s: _s not in _subscribers)
+            for _sock in _order:
+                # frames go through untouched, no decoding on the way
+                while _sock.poll(0, zmq.POLLIN):
+                    _frames = _sock.recv_multipart()
+                    if _sock is self._down_in_socket:
+                        if _merged and _frames[0] in _ctl_topics:
+                            _to = [self._ctl_out_socket]
+                        else:
+                            _to = [self._out_socket]
+                        self.counters['relayed_up'] += 1
+                    else:
+                        if _merged and _sock is self._ctl_out_socket:
+                            if _frames[0][:1] == '\x01':
+                                _ctl_topics.add(_frames[0][1:])
+                            else:
+                                _ctl_topics.discard(_frames[0][1:])
+                        _to = _routes[_sock]
+                        if _sock is self._in_socket or \
+                                _sock is self._ctl_in_socket:
+                            self.counters['relayed_down'] += 1
+                        elif _sock is self._down_ctl_in_socket:
+                            _to = _ctl_up
+                            self.counters['relayed_up'] += 1
+                    for _dest in _to:
+                        _dest.send_multipart(_frames)
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2013 Dave Carlson <thecubic@thecubic.net>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""wire envelope: [topic + TERMINATOR, header, payload?]
+
+the header is a fixed struct, followed by the chunk fields when
+F_CHUNK is set and then any addresses that wouldn't fit in 16 bytes,
+each as a length-prefixed string. callers only ever see
+[topic, addr, payload?] and a dict of whatever metadata was set.
+"""
+
+import struct
+import uuid
+
+ENVELOPE_VERSION = 1
+# ends every topic frame, so subscriptions match whole topics only
+TERMINATOR = '\x00'
+
+# version, flags, addr kind, sender kind, window or credit, sequence,
+# deadline or heartbeat time, addr id, sender id
+HEADER = struct.Struct('!BBBBHId16s16s')
+# chunk index, chunk count, total size, offset
+CHUNK = struct.Struct('!IIQQ')
+NAMELEN = struct.Struct('!H')
+
+F_SEQ = 0x01
+F_DEADLINE = 0x02
+F_SHED = 0x04
+F_WINDOW = 0x08
+F_CHUNK = 0x10
+F_CREDIT = 0x20
+F_HEARTBEAT = 0x40
+# sent on the control lane, which numbers its streams separately
+F_CONTROL = 0x80
+
+# a 16-byte id as is, e.g. a call's reply address
+KIND_RAW = 0
+# anything else, spelled out after the header
+KIND_NAMED = 255
+# "<swarmtype>=<uuid>" addresses pack down to a kind and the uuid
+KINDS = {'master': 1, 'drone': 2}
+SWARMTYPES = dict((_code, _swarmtype) for _swarmtype, _code in KINDS.items())
+
+NULL_ID = '\x00' * 16
+
+# both directions of the uniqueaddr <-> (kind, id) mapping, since the
+# same few addresses go by over and over
+_wire_addrs = dict()
+_names = dict()
+cache_limit = 65536
+
+
+def new_id():
+    "a fresh 16-byte id to address replies to"
+    return uuid.uuid4().bytes
+
+
+def wire_addr(name):
+    "(kind, 16-byte id, spelled-out name or '') for an address"
+    if len(name) == 16:
+        return KIND_RAW, name, ''
+    try:
+        return _wire_addrs[name]
+    except KeyError:
+        pass
+    _res = KIND_NAMED, NULL_ID, name
+    _swarmtype, _sep, _id = name.partition('=')
+    if _swarmtype in KINDS:
+        try:
+            _uuid = uuid.UUID(_id)
+        except ValueError:
+            _uuid = None
+        # only if it comes back out exactly the same
+        if _uuid is not None and str(_uuid) == _id:
+            _res = KINDS[_swarmtype], _uuid.bytes, ''
+    if len(_wire_addrs) >= cache_limit:
+        _wire_addrs.clear()
+    _wire_addrs[name] = _res
+    return _res
+
+
+def addr_name(kind, raw):
+    "the address a (kind, 16-byte id) stands for"
+    if kind == KIND_RAW:
+        return raw
+    try:
+        return _names[(kind, raw)]
+    except KeyError:
+        pass
+    _name = "%s=%s" % (SWARMTYPES[kind], uuid.UUID(bytes=raw))
+    if len(_names) >= cache_limit:
+        _names.clear()
+    _names[(kind, raw)] = _name
+    return _name
+
+
+def encode_envelope(topic, addr, payload=None, meta=None):
+    "frames to send for a message"
+    _flags, _window, _seq, _when = 0, 0, 0, 0.0
+    _sender = None
+    _chunk = ''
+    if meta:
+        if 'n' in meta:
+            _flags |= F_SEQ
+            _seq, _sender = meta['n'], meta['s']
+        if 'd' in meta:
+            _flags |= F_DEADLINE
+            _when = meta['d']
+        elif 'hb' in meta:
+            _flags |= F_HEARTBEAT
+            _when = meta['hb']
+        if meta.get('shed'):
+            _flags |= F_SHED
+        if meta.get('ctl'):
+            _flags |= F_CONTROL
+        if 'w' in meta:
+            _flags |= F_WINDOW
+            _window = meta['w']
+        elif 'credit' in meta:
+            _flags |= F_CREDIT
+            _window = meta['credit']
+        if 'k' in meta:
+            _flags |= F_CHUNK
+            _chunk = CHUNK.pack(meta['c'], meta['k'], meta['z'], meta['o'])
+    _akind, _araw, _aname = wire_addr(addr)
+    if _sender is None:
+        _skind, _sraw, _sname = KIND_RAW, NULL_ID, ''
+    else:
+        _skind, _sraw, _sname = wire_addr(_sender)
+    _header = HEADER.pack(ENVELOPE_VERSION, _flags, _akind, _skind,
+                          _window, _seq, _when, _araw, _sraw) + _chunk
+    for _kind, _name in ((_akind, _aname), (_skind, _sname)):
+        if _kind == KIND_NAMED:
+            _header += NAMELEN.pack(len(_name)) + _name
+    if payload is None:
+        return [topic + TERMINATOR, _header]
+    return [topic + TERMINATOR, _header, payload]
+
+
+def _read_addr(kind, raw, header, offset):
+    if kind != KIND_NAMED:
+        return addr_name(kind, raw), offset
+    (_len,) = NAMELEN.unpack_from(header, offset)
+    offset += NAMELEN.size
+    return header[offset:offset + _len], offset + _len
+
+
+def decode_envelope(frames):
+    "([topic, addr, payload?], metadata or None) from received frames"
+    if len(frames) not in (2, 3) or frames[0][-1:] != TERMINATOR:
+        raise ValueError("not an envelope: %r" % (frames,))
+    _header = frames[1]
+    if len(_header) < HEADER.size:
+        raise ValueError("short envelope header")
+    (_version, _flags, _akind, _skind, _window, _seq, _when,
+     _araw, _sraw) = HEADER.unpack_from(_header)
+    if _version != ENVELOPE_VERSION:
+        raise ValueError("envelope version %d, expected %d" %
+                         (_version, ENVELOPE_VERSION))
+    _offset = HEADER.size
+    _meta = dict()
+    if _flags & F_CHUNK:
+        _meta['c'], _meta['k'], _meta['z'], _meta['o'] = \
+            CHUNK.unpack_from(_header, _offset)
+        _offset += CHUNK.size
+    _addr, _offset = _read_addr(_akind, _araw, _header, _offset)
+    if _flags & F_SEQ:
+        _meta['s'], _offset = _read_addr(_skind, _sraw, _header, _offset)
+        _meta['n'] = _seq
+    if _flags & F_DEADLINE:
+        _meta['d'] = _when
+    if _flags & F_HEARTBEAT:
+        _meta['hb'] = _when
+    if _flags & F_SHED:
+        _meta['shed'] = True
+    if _flags & F_CONTROL:
+        _meta['ctl'] = True
+    if _flags & F_WINDOW:
+        _meta['w'] = _window
+    if _flags & F_CREDIT:
+        _meta['credit'] = _window
+    _frames = [frames[0][:-1], _addr]
+    if len(frames) == 3:
+        _frames.append(frames[2])
+    return _frames, _meta or None